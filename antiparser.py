@@ -6,6 +6,28 @@ import string
 import os
 import socket
 import time
+import hashlib
+import collections
+import bisect
+import concurrent.futures
+import asyncio
+import queue
+import select
+import mmap
+import threading
+import io
+import tarfile
+import zipfile
+import zlib
+import base64
+import binascii
+import urllib.parse
+import re
+import subprocess
+import signal
+import tempfile
+import logging
+import logging.handlers
 
 """antiparser - API for randomly generating different types of data for use in fuzzing.
 
@@ -27,6 +49,378 @@ makes it easy to keep track of particular permutations of antiparser data, which
 be recalled at any time.
 """
 
+# struct byte order prefixes for the byteorder property of data objects, None means native
+_BYTEORDERS = {"big": '>', "little": '<'}
+
+# payload plan step kinds
+_PACKED = "packed"
+_STRING = "string"
+_CSTRING = "cstring"
+_KEYWORDS = "keywords"
+_BLOCK = "block"
+
+# boundary sizes for incremental mode, each is followed by the next _DELTA sizes
+_BOUNDS = (16, 32, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+_DELTA = 4
+
+# modes that walk a schedule of values for numeric data objects, and the largest step of the
+# arithmetic walk
+_NUMBERMODES = ("incremental", "boundary", "bitflip", "arithmetic")
+_ARITHMAX = 35
+
+# kinds of derived numeric data objects, see apNumber.setDerived(), and the checksums they support as
+# (function, initial value) pairs for running updates, None meaning a plain byte sum
+_DERIVED = ("length", "count", "checksum")
+_CHECKSUMS = {"crc32": (zlib.crc32, 0), "adler32": (zlib.adler32, 1), "sum": (None, 0)}
+
+# encodings that string data objects can apply to their content, see apString.setEncoding()
+_ENCODERS = {
+    "base64": base64.b64encode,
+    "hex": binascii.hexlify,
+    "url": lambda data: urllib.parse.quote_from_bytes(data, safe="").encode('ascii'),
+    # XDR variable-length opaque data: a 4 byte big endian length, the data and zero padding to 4 bytes
+    "xdr": lambda data: struct.pack('>I', len(data)) + data + b'\x00' * (-len(data) % 4),
+}
+
+# data object attributes that change between permutations or do not affect the payload, and so
+# are left out of antiparser.getTemplateHash()
+_VOLATILE = ("currentkeyword", "revision", "layout", "watchers", "schedule", "scheduleHints", "charset", "charRange",
+             "encoded", "rendered", "debug")
+
+# apMonitor outcomes of failed cases by the name of their error, other errors are just "error"
+_OUTCOMES = {"ConnectionRefusedError": "refused", "ConnectionResetError": "reset", "BrokenPipeError": "reset",
+             "ConnectionAbortedError": "reset", "TimeoutError": "timeout", "timeout": "timeout"}
+# response codes at the start of a reply, ie: FTP, SMTP or HTTP status codes
+_RESPONSECODE = re.compile(rb"(?:HTTP/\d\.\d )?(\d{3})")
+_DIGITS = re.compile(rb"\d+")
+_BUCKETPREFIX = 128  # bytes at the start of a response that apMonitor buckets it by
+
+# debugging output of the antiparser and its data objects, see setDebug() and apLogQueue
+_log = logging.getLogger("antiparser")
+_debugHandler = None  # stdout handler installed by the first setDebug(True), if logging wasn't configured
+
+def _enableDebugLog():
+    """Makes debugging messages visible, printing them to stdout unless logging has been configured."""
+    global _debugHandler
+    if not _log.isEnabledFor(logging.DEBUG):
+        _log.setLevel(logging.DEBUG)
+    if _debugHandler is None and not _log.handlers and not logging.getLogger().handlers:
+        _debugHandler = logging.StreamHandler(sys.stdout)
+        _debugHandler.setFormatter(logging.Formatter("%(message)s"))
+        _log.addHandler(_debugHandler)
+
+
+def _substream(seed, field, index):
+    """Returns a random number generator for one data object in one case of a seeded antiparser.
+
+       The generator is seeded from a hash of the seed, the field position and the case index, so
+       every (field, case) pair gets an independent stream that can be recreated on its own.
+       Container level decisions use a field position of -1.
+    """
+    key = ("%d:%d:%d" % (seed, field, index)).encode()
+    return random.Random(int.from_bytes(hashlib.blake2b(key, digest_size=16).digest(), 'little'))
+
+
+def _randomBytes(size, charset=None, rng=random):
+    """Returns size random bytes drawn from the legal characters of charset.
+
+       The random buffer is mapped onto the legal characters with one bytes.translate() call.
+       Random bytes that would make the mapping biased are deleted by the same call and the
+       buffer is topped up until it is full, so every legal character is equally likely.
+    """
+    if charset is None or not charset.reject and len(charset.legal) == 256:
+        return _randbytes(rng, size)
+    if not charset.legal:
+        raise ValueError("every character is illegal, cannot generate content")
+    accept = 256 - len(charset.reject)
+    data = b""
+    while len(data) < size:
+        need = size - len(data)
+        data += _randbytes(rng, need * 256 // accept + 16).translate(charset.table, charset.reject)
+    return data[:size]
+
+
+def _randbytes(rng, size):
+    """Returns size random bytes from the random number generator rng."""
+    if size <= 0:
+        return b""
+    return rng.getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def _incrementalSizes(lower, upper):
+    """Returns the sorted, deduplicated content sizes that incremental mode steps through.
+
+       The sizes are lower to lower + delta, each boundary size between lower and upper to
+       boundary + delta, and upper to upper + delta.
+    """
+    sizes = set(range(lower, lower + _DELTA + 1))
+    for number in _BOUNDS:
+        if lower < number < upper:
+            sizes.update(range(number, number + _DELTA + 1))
+    sizes.update(range(upper, upper + _DELTA + 1))
+    return sorted(sizes)
+
+
+def _numberValues(mode, bits, signed, lower, upper, start, hints):
+    """Returns the values a numeric data object walks in one of the numeric modes, see apNumber."""
+    mask = 2 ** bits - 1
+    if signed:
+        (smallest, largest) = (-2 ** (bits - 1), 2 ** (bits - 1) - 1)
+    else:
+        (smallest, largest) = (0, mask)
+    if mode == "bitflip":
+        start &= mask
+        values = [start ^ (1 << bit) for bit in range(bits)]
+        values += [start ^ (3 << bit) for bit in range(bits - 1)]
+        values += [start ^ (15 << bit) for bit in range(bits - 3)]
+    elif mode == "arithmetic":
+        values = []
+        for delta in range(1, _ARITHMAX + 1):
+            values += [start + delta, start - delta]
+    else:
+        values = [0, 1, -1, lower, lower + 1, upper - 1, upper, 2 ** (bits - 1) - 1, -2 ** (bits - 1), mask]
+        for bit in range(bits + 1):
+            values += range(2 ** bit - _DELTA, 2 ** bit + _DELTA + 1)
+            values += range(-2 ** bit - _DELTA, -2 ** bit + _DELTA + 1)
+        for size in hints:
+            values += [size - 1, size, size + 1]
+        lower = max(lower, smallest)
+        upper = min(upper, largest)
+        return sorted(set(value for value in values if lower <= value <= upper))
+    # wrap the walks around to the range of the data type, C style
+    walk = []
+    for value in values:
+        value &= mask
+        if signed and value > largest:
+            value -= 2 ** bits
+        walk.append(value)
+    return list(dict.fromkeys(walk))
+
+
+def _isDerived(item):
+    """Returns True if item is a numeric data object whose value is derived from other data objects."""
+    return getattr(item, "derived", None) is not None
+
+
+def _fuzzDerived(value, bits, rng):
+    """Returns a plausible but wrong variation of a derived value: off by one, zero, all ones or a bit flip."""
+    mask = 2 ** bits - 1
+    choice = rng.randrange(6)
+    if choice == 0:
+        value += 1
+    elif choice == 1:
+        value -= 1
+    elif choice == 2:
+        value = 0
+    elif choice == 3:
+        value = mask
+    elif choice == 4:
+        value ^= 1 << rng.randrange(bits)
+    else:
+        value = rng.getrandbits(bits)
+    return value & mask
+
+
+def _sizeHints(objectList):
+    """Returns the sorted minsize and maxsize of every string data object in objectList.
+
+       Numeric data objects add these to their boundary tables.
+    """
+    hints = set()
+    for item in objectList:
+        if not isinstance(item, (apNumber, apBlock)):
+            hints.update((item.getMinSize(), item.getMaxSize()))
+    return tuple(sorted(hints))
+
+
+def _pairwiseRows(counts):
+    """Returns rows of level indexes that cover every pair of levels of every two factors.
+
+       counts is the number of levels of each factor.  The covering array is built with the
+       in-parameter-order (IPOG) strategy: start with every pair of the two largest factors, then
+       for each further factor pick the level that covers the most uncovered pairs in each existing
+       row, and add rows for the pairs that are still left over.
+    """
+    order = sorted(range(len(counts)), key=lambda factor: -counts[factor])
+    sizes = [counts[factor] for factor in order]
+    rows = [[first, second] for first in range(sizes[0]) for second in range(sizes[1])]
+    for k in range(2, len(sizes)):
+        # uncovered[j][level of j] is the set of levels of k that still need a row with that pair
+        uncovered = [[set(range(sizes[k])) for level in range(sizes[j])] for j in range(k)]
+        # horizontal growth
+        for (number, row) in enumerate(rows):
+            counter = collections.Counter()
+            for j in range(k):
+                if row[j] is not None:
+                    counter.update(uncovered[j][row[j]])
+            if counter:
+                level = counter.most_common(1)[0][0]
+            else:
+                level = number % sizes[k]
+            row.append(level)
+            for j in range(k):
+                if row[j] is not None:
+                    uncovered[j][row[j]].discard(level)
+        # vertical growth, rows added here leave the other factors open (None) for later pairs
+        added = {}
+        for j in range(k):
+            for (value, levels) in enumerate(uncovered[j]):
+                for level in sorted(levels):
+                    for row in added.get(level, ()):
+                        if row[j] is None:
+                            row[j] = value
+                            break
+                    else:
+                        row = [None] * (k + 1)
+                        row[j] = value
+                        row[k] = level
+                        added.setdefault(level, []).append(row)
+        for level in sorted(added):
+            rows.extend(added[level])
+    # put the factors back in their original order, open slots can take any level
+    result = []
+    for row in rows:
+        ordered = [0] * len(counts)
+        for (position, factor) in enumerate(order):
+            if row[position] is not None:
+                ordered[factor] = row[position]
+        result.append(ordered)
+    return result
+
+
+class _apCharset:
+    """Lookup tables for generating random characters outside of a set of illegal characters.
+
+       table maps every byte value onto a legal character, and reject lists the byte values at the
+       top of the range that would give the first few legal characters an unfair share of the
+       mapping.  Use _getCharset() rather than instantiating this directly, so that data objects
+       with the same illegal characters share their tables.
+    """
+
+    def __init__(self, illegal):
+        self.legal = bytes(c for c in range(256) if c not in illegal)
+        self.charRange = [chr(c) for c in self.legal]
+        count = len(self.legal)
+        if count:
+            self.table = bytes(self.legal[c % count] for c in range(256))
+            self.reject = bytes(range(count * (256 // count), 256))
+        else:
+            self.table = None
+            self.reject = b""
+
+
+_charsets = {}  # cache of _apCharset objects, keyed by illegal characters
+
+
+def _getCharset(illegalchars):
+    """Returns the shared _apCharset for a string of illegal characters."""
+    illegal = _toBytes(illegalchars)
+    charset = _charsets.get(illegal)
+    if charset is None:
+        charset = _charsets[illegal] = _apCharset(illegal)
+    return charset
+
+
+def _renderString(kind, item):
+    """Returns the list of pieces that make up a string data object in the payload."""
+    pieces = []
+    if kind is _KEYWORDS:
+        pieces.append(_toBytes(item.getCurrentKeyword()))
+        pieces.append(_toBytes(item.getSeparator()))
+    pieces.append(_encodeContent(item))
+    terminator = item.getTerminator()
+    if terminator is not None:
+        pieces.append(_toBytes(terminator))
+    if kind is _CSTRING:
+        pieces.append(b'\x00')
+    return pieces
+
+
+def _encodeContent(item):
+    """Returns the content of a string data object as bytes, run through its encodings.
+
+       The encoded content is cached on the data object along with the content it was encoded
+       from, so it is only encoded again once the content itself is replaced.
+    """
+    content = item.getContent()
+    if not item.encoding:
+        return _toBytes(content)
+    if item.encoded is not None and item.encoded[0] is content:
+        return item.encoded[1]
+    data = _toBytes(content)
+    for name in item.encoding:
+        data = _ENCODERS[name](data)
+    item.encoded = (content, data)
+    return data
+
+
+def _checkEncoding(encoding):
+    """Returns encoding, a name or list of names from _ENCODERS, as a tuple of names."""
+    if encoding is None:
+        return ()
+    if isinstance(encoding, str):
+        encoding = (encoding,)
+    for name in encoding:
+        if name not in _ENCODERS:
+            raise ValueError("unknown encoding %r" % (name,))
+    return tuple(encoding)
+
+
+def _piecesLength(pieces):
+    """Returns the length of a list of pieces, which are byte strings or (struct, values) tuples."""
+    length = 0
+    for piece in pieces:
+        if piece.__class__ is tuple:
+            length += piece[0].size
+        else:
+            length += len(piece)
+    return length
+
+
+def _writePieces(buffer, offset, pieces):
+    """Writes a list of pieces into buffer at offset, over bytes that are already there."""
+    for piece in pieces:
+        if piece.__class__ is tuple:
+            piece[0].pack_into(buffer, offset, *piece[1])
+            offset += piece[0].size
+        else:
+            buffer[offset:offset + len(piece)] = piece
+            offset += len(piece)
+
+
+def _joinPieces(pieces):
+    """Returns a list of pieces as one byte string."""
+    if len(pieces) == 1 and pieces[0].__class__ is not tuple:
+        return pieces[0]
+    buffer = bytearray(_piecesLength(pieces))
+    _writePieces(buffer, 0, pieces)
+    return buffer
+
+
+def _toBuffer(data):
+    """Converts string content to bytes, and passes anything else that supports the buffer protocol through as it is."""
+    if isinstance(data, str):
+        return data.encode('latin-1')
+    return data
+
+
+def _errorCounter(error):
+    """Returns the name of the apStats counter for a failed socket operation."""
+    if isinstance(error, ConnectionRefusedError):
+        return "refused"
+    if isinstance(error, (ConnectionResetError, BrokenPipeError, ConnectionAbortedError)):
+        return "resets"
+    if isinstance(error, socket.timeout):
+        return "timeouts"
+    return "errors"
+
+
+def _toBytes(data):
+    """Converts string content to bytes, mapping each character to the byte of the same value."""
+    if isinstance(data, str):
+        return data.encode('latin-1')
+    return bytes(data)
+
 
 class antiparser:
     """Main class - should be imported into fuzzer scripts."""
@@ -34,30 +428,57 @@ class antiparser:
     def __init__(self):
         """Constructor that is called when the class is instantiated."""
         self.objectList = []
-        self.payload = ""
-        self.modes = ["incremental", "random"]
-        self.debug = False  # debugging mode - will print various things if True
+        self.payload = b""
+        self.__buffer = bytearray()  # payload buffer, reused between permutations
+        self.__length = 0  # length of the payload in the buffer
+        self.__plan = None  # compiled payload plan, see __compilePlan()
+        self.__planLayouts = None  # layout revision of each data object when the plan was compiled
+        self.__dirty = set()  # data objects changed since the last payload, see apObject._touch()
+        self.__always = []  # steps rendered for every payload: optional steps and blocks
+        self.__slots = []
+        self.__spans = {}
+        self.__hints = None  # size hints for numeric data objects, see __getHints()
+        self.modes = ["incremental", "random", "boundary", "bitflip", "arithmetic"]
+        self.debug = False  # debugging mode - will log various things if True, see setDebug()
         self.version = "antiparser-2.0"
+        self.seed = None  # seed for deterministic permutations, see setSeed()
+        self.case = 0  # index of the next permutation
+        self.stats = None  # apStats that permutations are recorded in, see setStats()
 
     def append(self, item):
         """Append data to the antiparser.
 
-           This method also extracts a new payload from the data set.
+           The payload plan is compiled again, and a new payload extracted, the next time the
+           payload is asked for, so building a template one data object at a time stays cheap.
         """
         if self.debug:
-            print("++ Adding %s to %s ++" % (str(item), str(self)))
+            _log.debug("++ Adding %s to %s ++", item, self)
         self.objectList.append(item)
-        self.__extractPayload()
+        self.__invalidatePlan()
 
     def delete(self, item):
         """Remove data by name from the antiparser.
 
-           This method also extracts a new payload from the data set.
+           As with append(), a new payload is extracted the next time the payload is asked for.
         """
         if self.debug:
-            print("++ Removing %s from %s ++" % (str(item), str(self)))
+            _log.debug("++ Removing %s from %s ++", item, self)
         self.objectList.remove(item)
-        self.__extractPayload()
+        self.__invalidatePlan()
+
+    def __planStale(self):
+        if self.__plan is None:
+            return True
+        # only data objects that changed since the last payload can have changed their layout
+        layouts = self.__planLayouts
+        for item in self.__dirty:
+            if item.layout != layouts[item]:
+                return True
+        return False
+
+    def __invalidatePlan(self):
+        self.__plan = None
+        self.payload = None
 
     def display(self):
         """Prints all of the objects in the antiparser."""
@@ -67,9 +488,9 @@ class antiparser:
     def load(self, fileName):
         """Loads a file containing a saved antiparser permutation."""
         if self.debug:
-            print("++ Atempting to load %s ++" % fileName)
+            _log.debug("++ Atempting to load %s ++", fileName)
         try:
-            infile = file(fileName, 'r')
+            infile = open(fileName, 'rb')
             antiparserobject = pickle.load(infile)
         except IOError as msg:
             print("antiparser.load() error opening file: ")
@@ -80,22 +501,22 @@ class antiparser:
         except IOError as msg:
             print("antiparser.load() error closing file: ")
         if self.debug:
-            print("++ Creating antiparser data ++")
-        for item in antiparserobject.objectList:
-            self.append(item)
+            _log.debug("++ Creating antiparser data ++")
+        self.objectList.extend(antiparserobject.objectList)
+        self.__invalidatePlan()
         self.__extractPayload()
 
     def save(self, fileName):
         """Saves the current antiparser permutation to a file."""
         if self.debug:
-            print("++ Attempting to save %s to %s ++" % (str(self), fileName))
+            _log.debug("++ Attempting to save %s to %s ++", self, fileName)
         (directory, name) = os.path.split(fileName)
         try:
             if os.path.isdir(directory) or directory == "":
-                outfile = file(fileName, 'w')
+                outfile = open(fileName, 'wb')
             else:
                 os.mkdir(directory, 0o700)
-                outfile = file(fileName, 'w')
+                outfile = open(fileName, 'wb')
             pickle.dump(self, outfile, 2)
         except IOError as msg:
             print("antiparser.save() error opening file: ")
@@ -106,7 +527,7 @@ class antiparser:
         except IOError as msg:
             print("antiparser.save() error closing file: ")
         if self.debug:
-            print("++ Saved ++")
+            _log.debug("++ Saved ++")
 
     def version(self):
         """Prints the version."""
@@ -119,124 +540,310 @@ class antiparser:
     def writeFile(self, fileName):
         """Writes the payload to a file for use in file format fuzzing."""
         if self.debug:
-            print("++ Writing payload to %s ++" % fileName)
+            _log.debug("++ Writing payload to %s ++", fileName)
         (directory, name) = os.path.split(fileName)
         try:
-            if os.path.isdir(directory) or directory == "":
-                outfile = file(fileName, 'w')
-                outfile.write(self.getPayload())
-            else:
+            if not (os.path.isdir(directory) or directory == ""):
                 os.mkdir(directory, 0o700)
-                outfile = file(fileName, 'w')
-                outfile.write(self.getPayload())
-        except IOError as msg:
-            print("antiparser.writeFile() error opening file: ")
+            with open(fileName, 'wb') as outfile:
+                outfile.write(self.getPayloadView())
+        except OSError as msg:
+            print("antiparser.writeFile() error writing file: %s" % msg)
+
+    def writeFiles(self, target, count, prefix="case", suffix="", format=None):
+        """Writes the payloads of count permutations to files for use in file format fuzzing.
+
+           target is a directory, or a tar or zip archive, see apFileWriter.  Files are named after
+           the case index of their permutation, ie: prefix + "000042" + suffix, so that seeded cases
+           can be matched up with payloadAt().  Payloads are generated while an apFileWriter thread
+           writes the previous ones to disk.
+        """
+        if self.debug:
+            _log.debug("++ Writing %s payloads to %s ++", count, target)
+        first = self.case
+        width = max(6, len(str(first + count - 1)))
+        writer = apFileWriter(target, format)
         try:
-            outfile.close()
-        except IOError as msg:
-            print("antiparser.writeFile() error closing file: ")
-
-    def __extractPayload(self):
-        structfmt = ""
-        structlist = []
+            for (index, payload) in enumerate(self.iterPayloads(count), first):
+                writer.write("%s%0*d%s" % (prefix, width, index, suffix), payload)
+        finally:
+            writer.close()
+
+    def __compilePlan(self):
+        """Compiles the objectList into a payload plan.
+
+           The plan is a list of steps.  Runs of adjacent numeric data objects that share a byte order are
+           folded into a single precompiled struct.Struct, while string data objects get a slot of their own
+           since their length changes with every permutation.  Optional data objects always get a step of
+           their own so that they can be dropped from a payload without disturbing their neighbours, and so
+           do derived data objects, which are filled in once the rest of the payload is in place.
+        """
         if self.debug:
-            print("++ Extracting new payload from %s ++" % self.getList())
+            _log.debug("++ Compiling payload plan for %s ++", self)
+        plan = []
+        run = None  # current (byte order, format codes, items) run of numeric data objects
+        sizes = {}  # packed size of each numeric data object
         for item in self.objectList:
-            # deal with byte order and optional fields
-            if item.getByteOrder() is not None:
-                if item.ByteOrder.lower() == "big":
-                    structfmt += '>'
-                if item.ByteOrder.lower() == "little":
-                    structfmt += '<'
-            _inPayload = True  # control variable for optional flag
-            if item.getOptional():
-                choices = True, False,
-                _inPayload = random.choice(choices)
-
-            # apCString
-            if isinstance(item, apCString):
-                if _inPayload:
-                    terminator = item.getTerminator()
-                    if terminator is not None:
-                        length = str(len(item.getContent() + terminator))
-                    else:
-                        length = str(len(item.getContent()))
-                    structfmt += length + 's' + 'x'  # append a null
-                    if terminator is not None:
-                        structlist.append(str(item.getContent() + terminator))
-                    else:
-                        structlist.append(str(item.getContent()))
-
-            # apString
-            elif isinstance(item, apString):
-                if _inPayload:
-                    terminator = item.getTerminator()
-                    if terminator is not None:
-                        length = str(len(item.getContent() + terminator))
-                    else:
-                        length = str(len(item.getContent()))
-                    structfmt += length + 's'
-                    if terminator is not None:
-                        structlist.append(str(item.getContent() + terminator))
-                    else:
-                        structlist.append(str(item.getContent()))
-
-            # apKeywords
-            elif isinstance(item, apKeywords):
-                if _inPayload:
-                    terminator = item.getTerminator()
-                    if terminator is not None:
-                        length = str(
-                            len(item.getCurrentKeyword() + item.getSeparator() + item.getContent() + terminator))
-                    else:
-                        length = str(len(item.getCurrentKeyword() + item.getSeparator() + item.getContent()))
-                    structfmt += length + 's'
-                    if terminator is not None:
-                        structlist.append(
-                            str(item.getCurrentKeyword() + item.getSeparator() + item.getContent() + terminator))
-                    else:
-                        structlist.append(str(item.getCurrentKeyword() + item.getSeparator() + item.getContent()))
-
-            # apChar
-            elif isinstance(item, apChar):
-                if _inPayload:
-                    if item.getSigned():
-                        structfmt += 'b'
-                    else:
-                        structfmt += 'B'
-                    structlist.append(int(item.getContent()))
-
-            # apShort
-            elif isinstance(item, apShort):
-                if _inPayload:
-                    if item.getSigned():
-                        structfmt += 'h'
-                    else:
-                        structfmt += 'H'
-                    structlist.append(int(item.getContent()))
-
-            # apLong
-            elif isinstance(item, apLong):
-                if _inPayload:
-                    if item.getSigned():
-                        structfmt += 'l'
+            if isinstance(item, apNumber):
+                order = _BYTEORDERS.get(str(item.getByteOrder()).lower(), '=')
+                if isinstance(item, apChar):
+                    code = 'B'
+                elif isinstance(item, apShort):
+                    code = 'H'
+                else:
+                    code = 'L'
+                if item.getSigned():
+                    code = code.lower()
+                sizes[item] = struct.calcsize(order + code)
+                if item.getOptional() or _isDerived(item):
+                    plan.append((_PACKED, item.getOptional(), struct.Struct(order + code), [item]))
+                    run = None
+                elif run is not None and run[0] == order:
+                    run[1].append(code)
+                    run[2].append(item)
+                else:
+                    run = (order, [code], [item])
+                    plan.append(run)
+            else:
+                if isinstance(item, apCString):
+                    kind = _CSTRING
+                elif isinstance(item, apString):
+                    kind = _STRING
+                elif isinstance(item, apKeywords):
+                    kind = _KEYWORDS
+                elif isinstance(item, apBlock):
+                    kind = _BLOCK
+                else:
+                    continue
+                plan.append((kind, item.getOptional(), None, [item]))
+                run = None
+        # turn the numeric runs into precompiled structs
+        for index, step in enumerate(plan):
+            if len(step) == 3:
+                (order, codes, items) = step
+                plan[index] = (_PACKED, False, struct.Struct(order + ''.join(codes)), items)
+        # where each data object sits within its step, for getSpan()
+        spans = {}
+        for (index, (kind, optional, packer, items)) in enumerate(plan):
+            offset = 0
+            for item in items:
+                size = sizes.get(item)
+                spans[item] = (index, offset, size)
+                offset += size or 0
+        # derived data objects, lengths and counts first since checksums may cover them
+        derived = []
+        for (index, (kind, optional, packer, items)) in enumerate(plan):
+            item = items[0]
+            if kind is _PACKED and _isDerived(item):
+                for target in item.derived[1]:
+                    if target not in spans:
+                        raise ValueError("%s is derived from %s, which is not in the antiparser" % (item, target))
+                derived.append((item.derived[0] == "checksum", index, item))
+        derived.sort(key=lambda entry: entry[:2])
+        self.__plan = plan
+        self.__derived = [(index, item) for (checksum, index, item) in derived]
+        self.__always = [index for (index, (kind, optional, packer, items)) in enumerate(plan)
+                         if optional or kind is _BLOCK]
+        # data objects of the old plan stop reporting changes to it, those of the new one start,
+        # all of them dirty so that the first payload renders every step
+        old = self.__dirty
+        for item in self.__planLayouts or ():
+            item.watchers = [dirty for dirty in item.watchers if dirty is not old]
+        self.__dirty = set(spans)
+        for item in spans:
+            item.watchers.append(self.__dirty)
+        self.__planLayouts = dict((item, item.layout) for item in spans)
+        self.__spans = spans
+        # [offset, length, key] of each step in the last payload, the key tells when a step has to be
+        # rendered again
+        self.__slots = [[0, 0, None] for step in plan]
+        self.__buffer = bytearray()
+        self.__length = 0
+
+    def __extractPayload(self, rng=random):
+        """Renders the payload, patching only the steps whose data objects changed since the last payload.
+
+           Only the steps of data objects marked dirty by apObject._touch() are looked at, along
+           with optional steps and blocks, so a change to one data object costs the same however
+           many data objects there are.  If every changed step keeps its length, the new bytes are
+           written over the old ones in place.  If a single step changes length, it is spliced into
+           the buffer.  Otherwise the buffer is rebuilt, copying the unchanged steps from the old
+           buffer.
+        """
+        if self.debug:
+            _log.debug("++ Extracting new payload from %s ++", self.getList())
+        if self.__planStale():
+            self.__compilePlan()
+        plan = self.__plan
+        spans = self.__spans
+        steps = set(self.__always)
+        for item in self.__dirty:
+            steps.add(spans[item][0])
+        slots = self.__slots
+        dirty = []  # (slot index, pieces, length) of every step that has to be rendered again
+        resized = 0
+        for index in sorted(steps):
+            (kind, optional, packer, items) = plan[index]
+            # optional fields only make it into half of the payloads
+            included = not optional or rng.choice((True, False))
+            if kind is _PACKED:
+                key = (included, [item.revision for item in items])
+            else:
+                if kind is _BLOCK and included:
+                    # rendered once per payload, bumping the revision of the block if its children changed
+                    rendered = items[0].render(rng)
+                key = (included, items[0].revision)
+            slot = slots[index]
+            if key == slot[2]:
+                continue
+            slot[2] = key
+            if not included:
+                pieces = []
+            elif kind is _PACKED:
+                pieces = [(packer, [int(item.content) for item in items])]
+            elif kind is _BLOCK:
+                pieces = [rendered]
+            else:
+                pieces = _renderString(kind, items[0])
+            length = _piecesLength(pieces)
+            if length != slot[1]:
+                resized += 1
+            dirty.append((index, pieces, length))
+        self.__dirty.clear()
+        if dirty:
+            self.payload = None
+            self.__patchBuffer(dirty, resized)
+        if self.__derived:
+            self.__resolveDerived(rng)
+
+    def __patchBuffer(self, dirty, resized):
+        slots = self.__slots
+        buffer = self.__buffer
+        if not resized:
+            for (index, pieces, length) in dirty:
+                _writePieces(buffer, slots[index][0], pieces)
+            return
+        if len(dirty) == 1:
+            (index, pieces, length) = dirty[0]
+            (offset, oldLength) = slots[index][:2]
+            try:
+                buffer[offset:offset + oldLength] = _joinPieces(pieces)
+            except BufferError:
+                pass  # a caller still holds a view of the buffer, rebuild it instead
+            else:
+                slots[index][1] = length
+                for slot in slots[index + 1:]:
+                    slot[0] += length - oldLength
+                self.__length = len(buffer)
+                return
+        # rebuild the whole buffer
+        pending = [None] * len(slots)
+        for (index, pieces, length) in dirty:
+            pending[index] = (pieces, length)
+        total = 0
+        for (slot, update) in zip(slots, pending):
+            total += slot[1] if update is None else update[1]
+        old = memoryview(buffer)
+        buffer = bytearray(total)
+        offset = 0
+        for (slot, update) in zip(slots, pending):
+            if update is None:
+                buffer[offset:offset + slot[1]] = old[slot[0]:slot[0] + slot[1]]
+            else:
+                _writePieces(buffer, offset, update[0])
+                slot[1] = update[1]
+            slot[0] = offset
+            offset += slot[1]
+        old.release()
+        self.__buffer = buffer
+        self.__length = total
+
+    def __resolveDerived(self, rng):
+        """Fills in the derived data objects from the spans of the data objects they cover.
+
+           Checksums are computed with running updates over views of the payload buffer.  Derived
+           data objects hold their last value as content, so they are only written when it changes.
+        """
+        for (index, item) in self.__derived:
+            (packer, slot) = (self.__plan[index][2], self.__slots[index])
+            if not slot[1]:
+                continue  # optional and left out of this payload
+            (kind, targets, algorithm, variant) = item.derived
+            spans = [span for span in map(self.__locate, targets) if span is not None]
+            if kind == "length":
+                value = sum(size for (offset, size) in spans)
+            elif kind == "count":
+                value = len(spans)
+            else:
+                (update, value) = _CHECKSUMS[algorithm]
+                view = memoryview(self.__buffer)
+                for (offset, size) in spans:
+                    if update is None:
+                        value += sum(view[offset:offset + size])
                     else:
-                        structfmt += 'L'
-                    structlist.append(int(item.getContent()))
-
-            # pack and set the payload
-            payload = struct.pack(structfmt, *structlist)
-            self.__setPayload(payload)
+                        value = update(view[offset:offset + size], value)
+                view.release()
+            mask = 2 ** item.bits - 1
+            value &= mask
+            if variant == "fuzzed":
+                value = _fuzzDerived(value, item.bits, rng)
+            if item.getSigned() and value > mask >> 1:
+                value -= mask + 1
+            if value == item.content:
+                continue
+            if self.debug:
+                _log.debug("++ Setting derived %s of %s to: %s ++", kind, item, value)
+            item.content = value
+            packer.pack_into(self.__buffer, slot[0], value)
+            self.payload = None
+
+    def __locate(self, item):
+        (index, offset, size) = self.__spans[item]
+        slot = self.__slots[index]
+        if slot[1] == 0 and not slot[2][0]:
+            return None
+        if size is None:
+            size = slot[1]
+        return (slot[0] + offset, size)
+
+    def __getHints(self):
+        # worked out once per permuteMany() or payloadAt() call, since sizes may change in between
+        if self.__hints is None:
+            self.__hints = _sizeHints(self.objectList)
+        return self.__hints
+
+    def getDirty(self):
+        """Returns True if data objects changed since the payload was last extracted."""
+        return self.__planStale() or bool(self.__dirty)
+
+    def getSpan(self, item):
+        """Returns the (offset, length) of a data object within the current payload.
+
+           Returns None if the data object is optional and was left out of the current payload.
+        """
+        if self.__planStale():
+            self.__extractPayload()
+        return self.__locate(item)
 
     def getPayload(self):
         """Returns the payload of the current permutation.
 
            The payload is the random output to be used in fuzzer scripts.
         """
+        if self.payload is None or self.__plan is None:
+            self.payload = bytes(self.getPayloadView())
         return self.payload
 
-    def __setPayload(self, payload):
-        self.payload = payload
+    def getPayloadView(self):
+        """Returns a memoryview of the payload of the current permutation.
+
+           The payload is assembled in a buffer that is reused from one permutation to the next, so
+           unlike getPayload() this makes no copy.  The view can be passed to apSocket.sendTCP(),
+           apSocket.sendUDP() or a file as it is, but its contents change with the next permutation.
+        """
+        if self.__planStale():
+            self.__extractPayload()
+        return memoryview(self.__buffer)[:self.__length]
 
     def displayModes(self):
         """Display a list of supported modes for antiparser.permute()."""
@@ -253,7 +860,11 @@ class antiparser:
 
            setDebug() sets the debugging status for the antiparser container only.
            For global debugging of all data objects in the container, use setGlobalDebug().
+           Debugging messages go to the "antiparser" logger, and are printed to stdout if
+           logging hasn't been configured otherwise.
         """
+        if debug:
+            _enableDebugLog()
         self.debug = debug
 
     def getGlobalDebug(self):
@@ -273,6 +884,44 @@ class antiparser:
                 item.setDebug(False)
         self.setDebug(debug)
 
+    def getStats(self):
+        """Returns the apStats the antiparser records its permutations in, or None."""
+        return self.stats
+
+    def setStats(self, stats):
+        """Sets the apStats to record permutations in, or None to stop recording.  Defaults to None.
+
+           For every case generated by permute(), permuteMany() or payloadAt(), the apStats counts the
+           case and the bytes of each data object, and times the permute and pack phases.
+        """
+        self.stats = stats
+
+    def __addCase(self, stats, permuteTime, packTime):
+        spans = [self.__locate(item) if item in self.__spans else None for item in self.objectList]
+        stats.addCase(self.objectList, spans, permuteTime, packTime)
+
+    def refresh(self, rng=random):
+        """Extracts a new payload from the current content of the data objects.
+
+           Call refresh() after changing the content of data objects by hand, so that the payload
+           reflects it without permuting anything.  Optional data objects are included or left out
+           using rng.
+        """
+        self.__extractPayload(rng)
+
+    def combinations(self, strategy="product"):
+        """Returns an apCombinator that enumerates combinations of the antiparser data, see apCombinator."""
+        return apCombinator(self, strategy)
+
+    def reset(self):
+        """Resets the incremental mode schedule of every data object in the antiparser.
+
+           The next permutation of data objects in incremental mode will start over from the
+           first step of their schedule.
+        """
+        for item in self.objectList:
+            item.reset()
+
     def juggle(self):
         """Randomly rearrange the ordering of data objects in the antiparser instance.
 
@@ -281,111 +930,448 @@ class antiparser:
            the data if they wish.
         """
         random.shuffle(self.objectList)
+        self.__invalidatePlan()
         if self.debug:
-            print("++ Juggling contents of %s ++" % (str(self)))
-            print(self.getList())
+            _log.debug("++ Juggling contents of %s ++", self)
+            _log.debug("%s", self.getList())
         self.__extractPayload()
 
     def permute(self):
         """Creates a random permutation of the content for each data object in the antiparser."""
-        for item in self.objectList:
-            if item.getStatic() is False:
-                # check the mode
-                if item.getMode().lower() == "random":
-                    # should match all string types
-                    if self.debug:
-                        print("++ Permuting %s in random mode ++" % str(item))
-                    if isinstance(item, apString):
-                        tempList = []  # list to build string
-                        randomString = ""
-                        size = 0
-                        if item.getMinSize() == item.getMaxSize():
-                            size = item.getMinSize()
-                        else:
-                            size = random.randrange(item.getMinSize(), item.getMaxSize())
-                        for i in range(size):
-                            tempList.append(random.choice(item.charRange))
-                        randomString = string.join(tempList, '')
-                        item.setContent(randomString)
-                    elif (isinstance(item, apChar) or isinstance(item, apShort) or isinstance(item, apLong)):
-                        number = 0
-                        if item.getMinSize() == item.getMaxSize():
-                            number = item.getMinSize()
-                        else:
-                            number = random.randrange(item.getMinSize(), item.getMaxSize())
-                        item.setContent(number)
-                    elif isinstance(item, apKeywords):
-                        tempList = []  # list to build string
-                        randomString = ""
-                        randomKey = str(random.choice(item.keywords))
-                        size = ""
-                        if item.getMinSize() == item.getMaxSize():
-                            size = item.getMinSize()
-                        else:
-                            size = random.randrange(item.getMinSize(), item.getMaxSize())
-                        for i in range(size - 1):
-                            tempList.append(random.choice(item.charRange))
-                        item.setCurrentKeyword(randomKey)
-                        randomString = string.join(tempList, '')
-                        item.setContent(randomString)
-
-                # crap incremental mode -- not implemented for apChar/apShort/apLong
-                if item.getMode().lower() == "incremental":
-                    if self.debug:
-                        print("++ Permuting %s in incremental mode ++" % str(item))
-                    if isinstance(item, apString) or isinstance(item, apKeywords):
-                        # this algorithm really sucks but seems to work
-                        tempList = []
-                        randomString = ""
-                        boundsRange = [16, 32, 128, 256, 512, 1024, 2048,
-                                       4096, 8192, 16384, 32768, 65536]
-                        boundsList = []
-                        delta = 4
-                        size = 0
-                        currentSize = item.getContentSize()
-                        lower = item.getMinSize()
-                        upper = item.getMaxSize()
-
-                        # don't wanna exceed maxsize + delta
-                        if currentSize > upper + delta:
-                            currentSize = upper + delta
-                        # build lower + delta range
-                        boundsList.extend(list(range(lower, lower + delta + 1)))
-                        # build rest of range
-                        for number in boundsRange:
-                            if number not in boundsList:
-                                if number > lower and number < upper:
-                                    boundsList.extend(list(range(number, number + delta + 1)))
-                        # build upper + delta range
-                        for number in range(upper, upper + delta + 1):
-                            if number not in boundsList:
-                                boundsList.append(number)
-                        listiter = iter(boundsList)
-
-                        # avoid index+1 error using iterator
-                        for number in listiter:
-                            if currentSize < lower:
-                                size = lower
-                                break
-                            if currentSize == number:
-                                try:
-                                    size = next(listiter)
-                                except StopIteration:
-                                    size = boundsList[-1]
-                                break
-                        if isinstance(item, apKeywords):
-                            randomKey = str(random.choice(item.keywords))
-                            item.setCurrentKeyword(randomKey)
-
-                        for i in range(size):
-                            tempList.append(random.choice(item.charRange))
-                        randomString = string.join(tempList, '')
-                        item.setContent(randomString)
-                        if self.debug:
-                            print("Content Length: %s " % item.getContentSize())
+        self.permuteMany(1)
 
+    def permuteMany(self, count):
+        """Creates count permutations of the antiparser data and returns a list of their payloads.
+
+           permuteMany(count) is equivalent to calling permute() and getPayload() count times, but the
+           random content for all of the permutations of a data object is drawn from one bulk random
+           buffer rather than one character at a time.  The antiparser is left holding the last
+           permutation.  If a seed has been set with setSeed(), each permutation is generated
+           from its own deterministic random substreams instead, see payloadAt().
+        """
+        if self.seed is not None:
+            return [self.payloadAt(index) for index in range(self.case, self.case + count)]
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+        debug = self.debug and _log.isEnabledFor(logging.DEBUG)
+        self.__hints = None
+        draws = []
+        for item in self.objectList:
+            if item.getStatic() is False and not _isDerived(item):
+                values = self.__drawPermutations(item, count, debug=debug)
+                if values is not None:
+                    draws.append((item, values))
+        blocks = [item for item in self.objectList if isinstance(item, apBlock) and item.getStatic() is False]
+        if stats is not None:
+            # the bulk draws are shared out evenly between the cases
+            drawTime = (time.perf_counter() - start) / max(count, 1)
+        payloads = []
+        for index in range(count):
+            if stats is not None:
+                start = time.perf_counter()
+            for (item, values) in draws:
+                (keyword, content) = values[index]
+                if keyword is not None:
+                    item.setCurrentKeyword(keyword)
+                item.setContent(content)
+            for block in blocks:
+                block.permute()
+            if stats is not None:
+                permuted = time.perf_counter()
             # set the new payload based on changed content
             self.__extractPayload()
+            if stats is not None:
+                self.__addCase(stats, drawTime + permuted - start, time.perf_counter() - permuted)
+            payloads.append(self.getPayload())
+        self.case += count
+        return payloads
+
+    def payloadAt(self, index):
+        """Generates the permutation with the given case index and returns its payload.
+
+           payloadAt() requires a seed to be set with setSeed().  Every random decision made for a
+           data object in a permutation comes from a substream derived from the seed, the position
+           of the data object and the case index, so any case can be regenerated directly without
+           generating the cases before it.  Together with getTemplateHash(), the (template hash,
+           seed, index) triple returned by getCaseKey() is enough to reproduce a payload.
+        """
+        if self.seed is None:
+            raise ValueError("payloadAt() requires a seed, see antiparser.setSeed()")
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+        debug = self.debug and _log.isEnabledFor(logging.DEBUG)
+        self.__hints = None
+        for (field, item) in enumerate(self.objectList):
+            if item.getStatic() is False and not _isDerived(item):
+                values = self.__drawPermutations(item, 1, _substream(self.seed, field, index), index, debug)
+                if values is not None:
+                    (keyword, content) = values[0]
+                    if keyword is not None:
+                        item.setCurrentKeyword(keyword)
+                    item.setContent(content)
+            if isinstance(item, apBlock) and item.getStatic() is False:
+                item.payloadAt(index, _substream(self.seed, field, -1).getrandbits(64))
+        if stats is not None:
+            permuted = time.perf_counter()
+        self.__extractPayload(_substream(self.seed, -1, index))
+        if stats is not None:
+            self.__addCase(stats, permuted - start, time.perf_counter() - permuted)
+        self.case = index + 1
+        return self.getPayload()
+
+    def generateParallel(self, count, start=0, workers=None, ordered=True, chunkSize=256):
+        """Generator that yields (index, payload) for count cases, generated by a pool of processes.
+
+           The case space starting at start is split into shards of chunkSize cases, which are
+           generated with payloadAt() by worker processes that each hold a copy of the antiparser.
+           Since every case only depends on the seed and its index, case N is the same bytes no
+           matter how many workers there are.  If no seed has been set, a random one is set first;
+           getSeed() returns it.  workers defaults to the number of CPUs.  With ordered set to False,
+           cases are yielded as soon as their shard is done rather than in index order.
+        """
+        if self.seed is None:
+            self.setSeed(random.getrandbits(64))
+        if self.debug:
+            _log.debug("++ Generating %s cases of %s in parallel ++", count, self)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        shards = iter(range(start, start + count, chunkSize))
+        stop = start + count
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_initWorker,
+                                                          initargs=(self,))
+        # keep a bounded number of shards in flight so a slow consumer doesn't buffer everything
+        window = workers * 4
+        pending = collections.deque()
+        try:
+            for first in shards:
+                pending.append((first, executor.submit(_generateShard, first, min(first + chunkSize, stop))))
+                if len(pending) < window:
+                    continue
+                for result in self.__collectShards(pending, ordered):
+                    yield result
+            while pending:
+                for result in self.__collectShards(pending, ordered):
+                    yield result
+        finally:
+            for (first, future) in pending:
+                future.cancel()
+            executor.shutdown()
+
+    def __collectShards(self, pending, ordered):
+        if ordered:
+            (first, future) = pending.popleft()
+            done = [(first, future)]
+        else:
+            finished = concurrent.futures.wait([future for (first, future) in pending],
+                                               return_when=concurrent.futures.FIRST_COMPLETED)[0]
+            done = [(first, future) for (first, future) in pending if future in finished]
+            for shard in done:
+                pending.remove(shard)
+        for (first, future) in done:
+            for (offset, payload) in enumerate(future.result()):
+                yield (first + offset, payload)
+
+    def getSeed(self):
+        """Returns the seed used to generate permutations, or None if the global random module is used."""
+        return self.seed
+
+    def setSeed(self, seed):
+        """Sets the seed used to generate permutations and rewinds to the first case.
+
+           seed is an integer.  Once a seed is set, permute() generates cases 0, 1, 2... in order and
+           payloadAt() can seek to any case.  A seed of None, the default, goes back to using the
+           global random module.
+        """
+        if self.debug:
+            _log.debug("++ Setting seed for %s to: %s ++", self, seed)
+        if seed is not None:
+            seed = int(seed)
+        self.seed = seed
+        self.case = 0
+
+    def getCase(self):
+        """Returns the index of the next case to be generated."""
+        return self.case
+
+    def getTemplateHash(self):
+        """Returns a hex digest that identifies the layout and properties of the antiparser data.
+
+           The content of data objects is only part of the hash if they are static, so the hash
+           stays the same from one permutation to the next.
+        """
+        digest = hashlib.sha1()
+        for item in self.objectList:
+            properties = []
+            for (name, value) in sorted(item.__dict__.items()):
+                if name in _VOLATILE or name == "content" and not item.getStatic():
+                    continue
+                if name == "derived" and value is not None:
+                    # refer to the covered data objects by position, not by their addresses
+                    (kind, targets, algorithm, variant) = value
+                    value = (kind, [self.objectList.index(target) for target in targets], algorithm, variant)
+                elif name == "container":
+                    value = value.getTemplateHash()
+                properties.append((name, value))
+            digest.update(repr((item.__class__.__name__, properties)).encode())
+        return digest.hexdigest()
+
+    def getCaseKey(self, index=None):
+        """Returns the (template hash, seed, index) triple for a case, by default the last one generated."""
+        if index is None:
+            index = self.case - 1
+        return (self.getTemplateHash(), self.seed, index)
+
+    def iterPayloads(self, count, batchSize=256):
+        """Generator that yields the payloads of count permutations of the antiparser data.
+
+           Permutations are generated batchSize at a time with permuteMany(), which keeps memory
+           use bounded when generating very large numbers of payloads.
+        """
+        while count > 0:
+            batch = min(count, batchSize)
+            for payload in self.permuteMany(batch):
+                yield payload
+            count -= batch
+
+    def __drawPermutations(self, item, count, rng=random, index=None, debug=False):
+        """Draws count permutations of the content of a data object.
+
+           Returns a list of (keyword, content) tuples, where keyword is None for data objects other
+           than apKeywords, or None if the mode of the data object has nothing to permute.  Random
+           values come from rng, and index seeks incremental mode schedules to a given case.  debug
+           is decided once by the caller, rather than once per data object.
+        """
+        mode = item.getMode().lower()
+        isNumber = isinstance(item, apNumber)
+        keywords = None
+        if mode == "random":
+            if debug:
+                _log.debug("++ Permuting %s in random mode ++", item)
+            if item.getMinSize() == item.getMaxSize():
+                sizes = [item.getMinSize()] * count
+            else:
+                sizes = [rng.randrange(item.getMinSize(), item.getMaxSize()) for i in range(count)]
+            if isNumber or isinstance(item, apBlock):
+                return [(None, number) for number in sizes]
+            if isinstance(item, apKeywords):
+                sizes = [max(size - 1, 0) for size in sizes]
+        elif isNumber and mode in _NUMBERMODES:
+            if debug:
+                _log.debug("++ Permuting %s in %s mode ++", item, mode)
+            schedule = item.getSchedule(self.__getHints())
+            if index is not None:
+                schedule.seek(index)
+            return [(None, schedule.next()) for i in range(count)]
+        elif mode == "incremental" and not isNumber:
+            if debug:
+                _log.debug("++ Permuting %s in incremental mode ++", item)
+            schedule = item.getSchedule()
+            if index is not None:
+                schedule.seek(index)
+            sizes = [schedule.next() for i in range(count)]
+            if debug:
+                _log.debug("Content Length: %s ", sizes[-1])
+        else:
+            return None
+        if isinstance(item, apBlock):
+            return [(None, size) for size in sizes]
+        if isinstance(item, apKeywords):
+            keywords = [str(rng.choice(item.keywords)) for i in range(count)]
+        else:
+            keywords = [None] * count
+        # one random buffer for every permutation, sliced up afterwards
+        data = _randomBytes(sum(sizes), item.charset, rng)
+        values = []
+        offset = 0
+        for (keyword, size) in zip(keywords, sizes):
+            values.append((keyword, data[offset:offset + size]))
+            offset += size
+        return values
+
+    def __getstate__(self):
+        # compiled plans hold struct.Struct objects, which cannot be pickled, and the payload
+        # buffer is rebuilt from the payload
+        state = self.__dict__.copy()
+        state['_antiparser__plan'] = None
+        state['_antiparser__planLayouts'] = None
+        state['_antiparser__dirty'] = set()
+        state['payload'] = self.getPayload()
+        state['_antiparser__buffer'] = None
+        state['stats'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__buffer = bytearray(self.payload)
+        self.__length = len(self.payload)
+
+
+_workerTemplate = None  # antiparser held by each generateParallel() worker process
+
+
+def _initWorker(template):
+    global _workerTemplate
+    _workerTemplate = template
+
+
+def _generateShard(start, stop):
+    return [_workerTemplate.payloadAt(index) for index in range(start, stop)]
+
+
+class apStats:
+    """apStats collects counters and timings from an antiparser or apSocket that it is attached to.
+
+       Attach one with antiparser.setStats() or apSocket.setStats(); an apStats may be shared by
+       several of them, including from different threads.  Nothing is counted or timed while no
+       apStats is attached.  Counters are plain totals, such as "cases" or "resets".  Timings are
+       kept per phase ("permute", "pack", "send", "connect", "recv") as a count, a total and a
+       maximum in seconds.  The number of bytes each data object of an antiparser contributed is
+       kept per (position, type) of the data object.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Sets every counter and timing back to zero."""
+        with self.lock:
+            self.counters = collections.Counter()
+            self.timings = {}  # phase: [count, total seconds, max seconds]
+            self.fields = collections.Counter()  # (position, type name): bytes
+
+    def count(self, name, amount=1):
+        """Adds amount to the counter name."""
+        with self.lock:
+            self.counters[name] += amount
+
+    def time(self, phase, seconds):
+        """Records one timing of seconds for phase."""
+        with self.lock:
+            self.__time(phase, seconds)
+
+    def __time(self, phase, seconds):
+        timing = self.timings.get(phase)
+        if timing is None:
+            self.timings[phase] = [1, seconds, seconds]
+        else:
+            timing[0] += 1
+            timing[1] += seconds
+            if seconds > timing[2]:
+                timing[2] = seconds
+
+    def addCase(self, objectList, spans, permuteTime, packTime):
+        """Records one generated case, see antiparser.setStats().
+
+           spans holds the (offset, length) of each data object in objectList, or None.
+        """
+        with self.lock:
+            self.counters["cases"] += 1
+            for (position, (item, span)) in enumerate(zip(objectList, spans)):
+                if span is not None:
+                    self.counters["bytes"] += span[1]
+                    self.fields[(position, item.__class__.__name__)] += span[1]
+            self.__time("permute", permuteTime)
+            self.__time("pack", packTime)
+
+    def getDict(self):
+        """Returns a snapshot of the statistics as a dict of plain types, ie: for json.dump()."""
+        with self.lock:
+            timings = {}
+            for (phase, (count, total, longest)) in self.timings.items():
+                timings[phase] = {"count": count, "total": total, "max": longest,
+                                  "mean": total / count}
+            fields = [{"position": position, "type": name, "bytes": size}
+                      for ((position, name), size) in sorted(self.fields.items())]
+            return {"counters": dict(self.counters), "timings": timings, "fields": fields}
+
+    def getPrometheus(self, prefix="antiparser"):
+        """Returns the statistics in the Prometheus text exposition format."""
+        stats = self.getDict()
+        lines = []
+        for (name, value) in sorted(stats["counters"].items()):
+            lines.append("# TYPE %s_%s_total counter" % (prefix, name))
+            lines.append("%s_%s_total %s" % (prefix, name, value))
+        for (phase, timing) in sorted(stats["timings"].items()):
+            lines.append("# TYPE %s_%s_seconds summary" % (prefix, phase))
+            lines.append("%s_%s_seconds_sum %r" % (prefix, phase, timing["total"]))
+            lines.append("%s_%s_seconds_count %s" % (prefix, phase, timing["count"]))
+            lines.append("# TYPE %s_%s_seconds_max gauge" % (prefix, phase))
+            lines.append("%s_%s_seconds_max %r" % (prefix, phase, timing["max"]))
+        if stats["fields"]:
+            lines.append("# TYPE %s_field_bytes_total counter" % prefix)
+            for field in stats["fields"]:
+                lines.append('%s_field_bytes_total{position="%s",type="%s"} %s' % (prefix, field["position"],
+                                                                                   field["type"], field["bytes"]))
+        return "\n".join(lines) + "\n"
+
+
+class apLogQueue:
+    """apLogQueue hands the debugging messages of the antiparser to a background thread.
+
+       While started, messages logged to the "antiparser" logger are put on a queue and passed
+       to handlers, by default a stdout handler, from a logging.handlers.QueueListener thread,
+       so slow log I/O never holds up case generation.
+    """
+
+    def __init__(self, *handlers):
+        if not handlers:
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            handlers = (handler,)
+        self.queue = queue.SimpleQueue()
+        self.handler = logging.handlers.QueueHandler(self.queue)
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+
+    def start(self):
+        """Starts passing messages through the queue, in place of the stdout handler of setDebug()."""
+        global _debugHandler
+        if _debugHandler is not None:
+            _log.removeHandler(_debugHandler)
+            _debugHandler = None
+        self.listener.start()
+        _log.addHandler(self.handler)
+
+    def stop(self):
+        """Stops queueing messages, and waits for the queued ones to be handled."""
+        _log.removeHandler(self.handler)
+        self.listener.stop()
+
+
+class apSchedule:
+    """apSchedule is a precomputed, sorted list of values for a data object to step through.
+
+       Each call to next() returns the value at the cursor and advances the cursor, so stepping
+       through the schedule costs O(1).  Once the cursor reaches the last value the schedule keeps
+       returning it until reset() is called.
+    """
+
+    def __init__(self, values):
+        self.values = values
+        self.position = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def next(self):
+        """Returns the value at the cursor and advances the cursor."""
+        value = self.values[min(self.position, len(self.values) - 1)]
+        self.position += 1
+        return value
+
+    def reset(self):
+        """Moves the cursor back to the first value of the schedule."""
+        self.position = 0
+
+    def seek(self, position):
+        """Moves the cursor to position, so that the next value is the one for that step."""
+        self.position = position
+
+    def getPosition(self):
+        """Returns the number of values taken from the schedule since it was built or reset."""
+        return self.position
 
 
 class apObject:
@@ -401,8 +1387,29 @@ class apObject:
         self.content = ""
         self.byteorder = None
         self.mode = "random"
+        self.revision = 0  # bumped whenever the rendered data object changes
+        self.layout = 0  # bumped whenever a change alters the payload plan of the antiparser holding it
+        self.watchers = []  # dirty sets of the antiparsers whose payload plan holds the data object
+        self.schedule = None  # incremental mode schedule, built by getSchedule()
         self.debug = False
 
+    def __getstate__(self):
+        # the dirty sets belong to the antiparsers holding the data object, which register again
+        state = self.__dict__.copy()
+        state['watchers'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.watchers = []
+
+    def _touch(self):
+        # bumps the revision and marks the data object dirty in every antiparser holding it, so
+        # that only the steps of changed data objects are rendered again
+        self.revision += 1
+        for dirty in self.watchers:
+            dirty.add(self)
+
     def display(self):
         """Print the data object."""
         print("Data Object: %s" % str(self))
@@ -414,8 +1421,14 @@ class apObject:
         return self.content
 
     def setContent(self, content):
-        """Sets the content of the data object."""
+        """Sets the content of the data object.
+
+           Setting the content marks the data object as changed, so that antiparser containers
+           render it again for the next payload.  Assigning to the content attribute directly
+           does not.
+        """
         self.content = content
+        self._touch()
 
     def getMinSize(self):
         """Returns the minsize property of the data object."""
@@ -424,8 +1437,9 @@ class apObject:
     def setMinSize(self, minsize):
         """Sets the minsize property of the data object to an integer."""
         if self.debug:
-            print("++ Setting minsize for %s to: %s ++" % (str(self), minsize))
+            _log.debug("++ Setting minsize for %s to: %s ++", self, minsize)
         self.minsize = minsize
+        self.schedule = None
 
     def getMaxSize(self):
         """Gets the maxsize property of the data object."""
@@ -434,8 +1448,9 @@ class apObject:
     def setMaxSize(self, maxsize):
         """Sets the maxsize property of the data object to an integer."""
         if self.debug:
-            print("++ Setting maxsize for %s to: %s ++" % (str(self), maxsize))
+            _log.debug("++ Setting maxsize for %s to: %s ++", self, maxsize)
         self.maxsize = maxsize
+        self.schedule = None
 
     def getOptional(self):
         """Return the optional property value of the data object."""
@@ -452,8 +1467,10 @@ class apObject:
            data object in the antiparser payload.
         """
         if self.debug:
-            print("++ Setting optional attribute for %s to: %s ++" % (str(self), optional))
+            _log.debug("++ Setting optional attribute for %s to: %s ++", self, optional)
         self.optional = optional
+        self.layout += 1
+        self._touch()
 
     def getStatic(self):
         """Returns the static property value of the data object."""
@@ -470,7 +1487,7 @@ class apObject:
            the data object.
         """
         if self.debug:
-            print("++ Setting static attribute for %s to: %s ++" % (str(self), static))
+            _log.debug("++ Setting static attribute for %s to: %s ++", self, static)
         self.static = static
 
     def getByteOrder(self):
@@ -485,8 +1502,10 @@ class apObject:
            which generally means that the native byteorder is used.
         """
         if self.debug:
-            print("++ Setting byteorder attribute for %s to: %s ++" % (str(self), byteorder))
+            _log.debug("++ Setting byteorder attribute for %s to: %s ++", self, byteorder)
         self.byteorder = byteorder
+        self.layout += 1
+        self._touch()
 
     def getMode(self):
         """Returns the mode that is currently enabled for the data object."""
@@ -499,10 +1518,28 @@ class apObject:
            may wish to generate random objects of random size, within the bounds
            of the minsize and maxsize attributes.  This is the default mode.  Other
            modes may allow the user to generate data of incrementally larger sizes.
+           The numeric data objects support the "incremental" or "boundary",
+           "bitflip" and "arithmetic" modes, see apNumber.
         """
         if self.debug:
-            print("++ Setting mode for %s to: %s" % (str(self), mode))
+            _log.debug("++ Setting mode for %s to: %s", self, mode)
         self.mode = mode
+        self.schedule = None
+
+    def getSchedule(self):
+        """Returns the apSchedule that the data object steps through in incremental mode.
+
+           The schedule is precomputed on first use and is only rebuilt after the minsize or
+           maxsize properties change.  len() of the schedule is the number of steps it takes
+           for the data object to reach its largest size.
+        """
+        if self.schedule is None:
+            self.schedule = apSchedule(_incrementalSizes(self.minsize, self.maxsize))
+        return self.schedule
+
+    def reset(self):
+        """Resets the incremental mode schedule of the data object to its first step."""
+        self.getSchedule().reset()
 
     def getDebug(self):
         """Returns the debugging status of the data object."""
@@ -510,6 +1547,8 @@ class apObject:
 
     def setDebug(self, debug):
         """Sets the debugging status to True or False.  Defaults to False."""
+        if debug:
+            _enableDebugLog()
         self.debug = debug
 
 
@@ -520,14 +1559,28 @@ class apString(apObject):
         apObject.__init__(self)
         self.illegalchars = ""
         self.charRange = []
+        self.charset = None
         self.terminator = None
+        self.encoding = ()  # names of the encodings applied to the content, in order
+        self.encoded = None  # (content, encoded content) cache
         self.__extractCharRange()
 
     def __extractCharRange(self):
-        charTable = ""
-        tempRange = ""
-        charTable = string.maketrans('', '')
-        self.charRange = list(string.translate(charTable, charTable, self.illegalchars))
+        self.charset = _getCharset(self.illegalchars)
+        self.charRange = self.charset.charRange
+
+    def __getstate__(self):
+        # the character tables are shared between data objects, so rebuild them on load
+        # rather than pickling them with every data object
+        state = apObject.__getstate__(self)
+        del state['charset']
+        del state['charRange']
+        state['encoded'] = None
+        return state
+
+    def __setstate__(self, state):
+        apObject.__setstate__(self, state)
+        self.__extractCharRange()
 
     def getIllegalChars(self):
         """Returns a list of illegal characters."""
@@ -542,7 +1595,7 @@ class apString(apObject):
            the charRange field.
         """
         if self.debug:
-            print("++ Setting illegal character range for %s to: %s ++" % (str(self), chars))
+            _log.debug("++ Setting illegal character range for %s to: %s ++", self, chars)
         self.illegalchars = chars
         self.__extractCharRange()
 
@@ -559,8 +1612,27 @@ class apString(apObject):
            data object.
         """
         if self.debug:
-            print("++ Setting terminator characters for %s to: %s ++" % (str(self), terminator))
+            _log.debug("++ Setting terminator characters for %s to: %s ++", self, terminator)
         self.terminator = terminator
+        self._touch()
+
+    def getEncoding(self):
+        """Returns the tuple of encodings applied to the content."""
+        return self.encoding
+
+    def setEncoding(self, encoding):
+        """Sets the encoding, or list of encodings, applied to the content of the data object.
+
+           encoding is "base64", "hex", "url" (percent-encoding of every byte but letters, digits
+           and "_.-~"), "xdr" (a length prefixed, padded XDR opaque), a list of these applied in
+           order, or None for the raw content, the default.  Only the content is encoded, not the
+           terminator.  The encoded content is cached until the content changes.
+        """
+        if self.debug:
+            _log.debug("++ Setting encoding for %s to: %s ++", self, encoding)
+        self.encoding = _checkEncoding(encoding)
+        self.encoded = None
+        self._touch()
 
     def getContentSize(self):
         """Returns the length of the current content."""
@@ -593,15 +1665,29 @@ class apKeywords(apObject):
         self.currentkeyword = ""
         self.illegalchars = ""
         self.charRange = []
+        self.charset = None
         self.terminator = None
         self.separator = ""
+        self.encoding = ()  # names of the encodings applied to the content, in order
+        self.encoded = None  # (content, encoded content) cache
         self.__extractCharRange()
 
     def __extractCharRange(self):
-        charTable = ""
-        tempRange = ""
-        charTable = string.maketrans('', '')
-        self.charRange = list(string.translate(charTable, charTable, self.illegalchars))
+        self.charset = _getCharset(self.illegalchars)
+        self.charRange = self.charset.charRange
+
+    def __getstate__(self):
+        # the character tables are shared between data objects, so rebuild them on load
+        # rather than pickling them with every data object
+        state = apObject.__getstate__(self)
+        del state['charset']
+        del state['charRange']
+        state['encoded'] = None
+        return state
+
+    def __setstate__(self, state):
+        apObject.__setstate__(self, state)
+        self.__extractCharRange()
 
     def getIllegalChars(self):
         """Returns a list of illegal characters."""
@@ -616,7 +1702,7 @@ class apKeywords(apObject):
            the charRange field.
         """
         if self.debug:
-            print("++ Setting illegal character range for %s to: %s ++" % (str(self), chars))
+            _log.debug("++ Setting illegal character range for %s to: %s ++", self, chars)
         self.illegalchars = chars
         self.__extractCharRange()
 
@@ -633,8 +1719,9 @@ class apKeywords(apObject):
            data object.
         """
         if self.debug:
-            print("++ Setting terminator characters for %s to: %s ++" % (str(self), terminator))
+            _log.debug("++ Setting terminator characters for %s to: %s ++", self, terminator)
         self.terminator = terminator
+        self._touch()
 
     def getSeparator(self):
         """Returns the separator string for the keywords."""
@@ -649,8 +1736,27 @@ class apKeywords(apObject):
            and the content.
         """
         if self.debug:
-            print("+++ Setting separator for %s to: %s +++" % (str(self) + separator))
+            _log.debug("+++ Setting separator for %s to: %s +++", self, separator)
         self.separator = separator
+        self._touch()
+
+    def getEncoding(self):
+        """Returns the tuple of encodings applied to the content."""
+        return self.encoding
+
+    def setEncoding(self, encoding):
+        """Sets the encoding, or list of encodings, applied to the content of the data object.
+
+           encoding is "base64", "hex", "url" (percent-encoding of every byte but letters, digits
+           and "_.-~"), "xdr" (a length prefixed, padded XDR opaque), a list of these applied in
+           order, or None for the raw content, the default.  Only the content is encoded, not the
+           terminator, keyword or separator.  The encoded content is cached until the content changes.
+        """
+        if self.debug:
+            _log.debug("++ Setting encoding for %s to: %s ++", self, encoding)
+        self.encoding = _checkEncoding(encoding)
+        self.encoded = None
+        self._touch()
 
     def getKeywords(self):
         """Returns the list of keywords associated with the data object."""
@@ -665,11 +1771,11 @@ class apKeywords(apObject):
            keyword associated with the data object to the first keyword in the list.
         """
         if self.debug:
-            print("++ Setting keyword list for %s to: %s ++" % (str(self), keywords))
+            _log.debug("++ Setting keyword list for %s to: %s ++", self, keywords)
         self.keywords = keywords
         self.setCurrentKeyword(self.keywords[0])
         if self.debug:
-            print("++ Setting initial keyword value to: %s ++" % self.getCurrentKeyword())
+            _log.debug("++ Setting initial keyword value to: %s ++", self.getCurrentKeyword())
 
     def getCurrentKeyword(self):
         """Returns the current keyword associated with the data object."""
@@ -678,27 +1784,131 @@ class apKeywords(apObject):
     def setCurrentKeyword(self, keyword):
         """Sets the current keyword associated with the data object."""
         self.currentkeyword = keyword
+        self._touch()
 
     def getContentSize(self):
         """Returns the length of the current content."""
         return len(self.content)
 
 
-class apChar(apObject):
-    """apChar represents the char 8-bit C data type."""
+class apNumber(apObject):
+    """Parent class of the C numeric data objects -- not be invoked directly.
+
+       Besides random mode, numeric data objects can walk a precomputed schedule of values:
+
+       "incremental" or "boundary" walks a sorted, deduplicated table of interesting values between
+       minsize and maxsize: 0 and +/-1, each power of two +/- a small delta, the signed and unsigned
+       limits of the data type, and the minsize and maxsize of the other data objects in the
+       antiparser +/- 1, which is where length field bugs hide.
+
+       "bitflip" flips one, then two, then four adjacent bits at each position of the starting value.
+
+       "arithmetic" adds and subtracts 1 to 35 from the starting value, wrapping around like C does.
+
+       The walks start from the content the data object holds when its mode is set with setMode(),
+       so they stay the same however often the schedule is rebuilt.
+
+       A numeric data object can also be derived from other data objects in the same antiparser,
+       see setDerived(), in which case its value is computed while the payload is packed rather
+       than permuted.
+    """
+
+    bits = 0
 
     def __init__(self):
         apObject.__init__(self)
+        self.scheduleHints = ()
+        self.derived = None  # (kind, items, algorithm, variant) of a derived data object
+        self.start = None  # starting value of the bitflip and arithmetic walks, see setMode()
+
+    def setMode(self, mode):
+        """Sets the mode for the data object, see apObject.setMode().
+
+           The content the data object holds now is recorded as the starting value of the
+           bitflip and arithmetic walks.
+        """
+        apObject.setMode(self, mode)
+        self.start = int(self.content)
+
+    def getDerived(self):
+        """Returns the (kind, items, algorithm, variant) the data object is derived from, or None."""
+        return self.derived
+
+    def setDerived(self, kind, items=(), algorithm=None, variant="correct"):
+        """Derives the value of the data object from other data objects in the antiparser.
+
+           kind is "length" for the total length of items in the payload, "count" for the number of
+           items included in the payload, "checksum" for a checksum of the bytes of items, or None
+           to go back to permuting the data object.  items is a data object or a list of data
+           objects, usually a run of adjacent fields.  algorithm is the checksum to compute,
+           "crc32" (the default), "adler32" or "sum".  Values that do not fit the data type are
+           truncated to it, like C does.  With variant set to "fuzzed" rather than "correct", every
+           payload gets a wrong but plausible value instead: off by one, zero, all ones, a flipped
+           bit or a random value.
+        """
+        if kind is not None and kind not in _DERIVED:
+            raise ValueError("unknown derived kind %r" % (kind,))
+        if kind == "checksum" and algorithm is None:
+            algorithm = "crc32"
+        if algorithm is not None and algorithm not in _CHECKSUMS:
+            raise ValueError("unknown checksum algorithm %r" % (algorithm,))
+        if variant not in ("correct", "fuzzed"):
+            raise ValueError("unknown derived variant %r" % (variant,))
+        if isinstance(items, apObject):
+            items = [items]
+        if self.debug:
+            _log.debug("++ Deriving %s from the %s of %s ++", self, kind, items)
+        if kind is None:
+            self.derived = None
+        else:
+            self.derived = (kind, list(items), algorithm, variant)
+        self.layout += 1
+        self._touch()
+
+    def setLengthOf(self, items, variant="correct"):
+        """Derives the data object from the total length of items, see setDerived()."""
+        self.setDerived("length", items, None, variant)
+
+    def setCountOf(self, items, variant="correct"):
+        """Derives the data object from the number of items included in the payload, see setDerived()."""
+        self.setDerived("count", items, None, variant)
+
+    def setChecksumOf(self, items, algorithm="crc32", variant="correct"):
+        """Derives the data object from a checksum of items, see setDerived()."""
+        self.setDerived("checksum", items, algorithm, variant)
+
+    def getSigned(self):
+        """Returns the value of the signed field for the data object."""
+        return self.signed
+
+    def getSchedule(self, hints=()):
+        """Returns the apSchedule of values the data object walks in its current mode.
+
+           hints is a sequence of sizes of other data objects to add to the boundary table.  The
+           schedule is only rebuilt when the mode, minsize, maxsize, signed field or hints change.
+        """
+        if self.schedule is None or hints != self.scheduleHints:
+            if self.start is None:
+                self.start = int(self.content)
+            self.scheduleHints = hints
+            self.schedule = apSchedule(_numberValues(self.mode.lower(), self.bits, self.signed, self.minsize,
+                                                     self.maxsize, self.start, hints))
+        return self.schedule
+
+
+class apChar(apNumber):
+    """apChar represents the char 8-bit C data type."""
+
+    bits = 8
+
+    def __init__(self):
+        apNumber.__init__(self)
         self.content = 0
         # default to unsigned
         self.signed = False
         self.minsize = 0
         self.maxsize = 2 ** 8 - 1
 
-    def getSigned(self):
-        """Returns the value of the signed field for the data object."""
-        return self.signed
-
     def setSigned(self, signed):
         """Sets the value of the signed field for the data object.
 
@@ -708,8 +1918,10 @@ class apChar(apObject):
         setting the signed field.
         """
         if self.debug:
-            print("+++ Setting signed value for %s to: %s" % (str(self), signed))
+            _log.debug("+++ Setting signed value for %s to: %s", self, signed)
         self.signed = signed
+        self.layout += 1
+        self._touch()
 
         if self.signed:
             self.setMinSize(-2 ** 7)
@@ -719,21 +1931,19 @@ class apChar(apObject):
             self.setMaxSize(2 ** 8)
 
 
-class apShort(apObject):
+class apShort(apNumber):
     """apShort represents the short 16-bit C data type."""
 
+    bits = 16
+
     def __init__(self):
-        apObject.__init__(self)
+        apNumber.__init__(self)
         self.content = 0
         # default to unsigned
         self.signed = False
         self.minsize = 0
         self.maxsize = 2 ** 16 - 1
 
-    def getSigned(self):
-        """Returns the value of the signed field for the data object."""
-        return self.signed
-
     def setSigned(self, signed):
         """Sets the value of the signed field for the data object.
 
@@ -743,31 +1953,31 @@ class apShort(apObject):
         setting the signed field.
         """
         if self.debug:
-            print("+++ Setting signed value for %s to: %s" % (str(self), signed))
+            _log.debug("+++ Setting signed value for %s to: %s", self, signed)
         self.signed = signed
+        self.layout += 1
+        self._touch()
         if self.signed:
             self.setMinSize(-2 ** 15)
             self.setMaxSize(2 ** 15 - 1)
         else:
             self.setMinSize(0)
-            self.setMaxsize(2 ** 16)
+            self.setMaxSize(2 ** 16)
 
 
-class apLong(apObject):
+class apLong(apNumber):
     """apLong represents the short 32-bit C data type."""
 
+    bits = 32
+
     def __init__(self):
-        apObject.__init__(self)
+        apNumber.__init__(self)
         self.content = 0
         # default to unsigned
         self.signed = False
         self.minsize = 0
         self.maxsize = 2 ** 32 - 1
 
-    def getSigned(self):
-        """Returns the value of the signed field for the data object."""
-        return self.signed
-
     def setSigned(self, signed):
         """Sets the value of the signed field for the data object.
 
@@ -777,8 +1987,10 @@ class apLong(apObject):
         setting the signed field.
         """
         if self.debug:
-            print("+++ Setting signed value for %s to: %s" % (str(self), signed))
+            _log.debug("+++ Setting signed value for %s to: %s", self, signed)
         self.signed = signed
+        self.layout += 1
+        self._touch()
         if self.signed:
             self.setMinSize(-2 ** 31)
             self.setMaxSize(2 ** 31 - 1)
@@ -787,6 +1999,95 @@ class apLong(apObject):
             self.setMaxSize(2 ** 32 - 1)
 
 
+class apBlock(apObject):
+    """apBlock is a data object that contains data objects of its own, repeated as a unit.
+
+       A block holds an antiparser container of its own, so it can be used to nest a group of data
+       objects such as a TLV record or a PNG chunk, which other data objects can then refer to as a
+       whole, ie: a length field set with apNumber.setLengthOf(block).  Derived data objects within
+       the block are resolved against the other data objects in the block.
+
+       The content of a block is the number of times its payload is repeated, which is permuted
+       between minsize and maxsize like a numeric data object and defaults to 1.  Permuting the
+       antiparser permutes the data objects in the block as well, and the rendered block is
+       memoized, so a block whose children did not change is copied into the payload as it is.
+       Like any other data object, a static block is left as it is by permute() and payloadAt().
+    """
+
+    def __init__(self):
+        apObject.__init__(self)
+        self.container = antiparser()
+        self.content = 1
+        self.minsize = 1
+        self.maxsize = 1
+        self.rendered = None  # (container payload, repeat count, block bytes) of the last render
+
+    def __getstate__(self):
+        state = apObject.__getstate__(self)
+        state['rendered'] = None
+        return state
+
+    def append(self, item):
+        """Appends a data object to the block."""
+        if self.debug:
+            _log.debug("++ Adding %s to %s ++", item, self)
+        self.container.append(item)
+        self._touch()
+
+    def delete(self, item):
+        """Removes a data object from the block."""
+        if self.debug:
+            _log.debug("++ Removing %s from %s ++", item, self)
+        self.container.delete(item)
+        self._touch()
+
+    def getList(self):
+        """Returns the list of data objects in the block."""
+        return self.container.getList()
+
+    def getContainer(self):
+        """Returns the antiparser container that holds the data objects of the block."""
+        return self.container
+
+    def setContent(self, content):
+        """Sets the number of times the payload of the block is repeated."""
+        if content != self.content:
+            apObject.setContent(self, content)
+
+    def permute(self):
+        """Creates a random permutation of the content of each data object in the block."""
+        self.container.permute()
+
+    def payloadAt(self, index, seed):
+        """Generates case index of the data objects in the block from seed, see antiparser.payloadAt()."""
+        if self.container.getSeed() != seed:
+            self.container.setSeed(seed)
+        self.container.payloadAt(index)
+
+    def render(self, rng=random):
+        """Returns the rendered block, its payload repeated content times.
+
+           Only data objects in the block that changed are rendered again, and the block itself is
+           only assembled again, bumping its revision, once its payload or repeat count changes.
+           The payload of the block is only extracted again if its data objects changed since
+           permute() or payloadAt(), so which optional data objects are included is decided once
+           per case.
+        """
+        if self.container.getDirty():
+            self.container.refresh(rng)
+        payload = self.container.getPayload()
+        rendered = self.rendered
+        if rendered is None or rendered[0] is not payload or rendered[1] != self.content:
+            rendered = self.rendered = (payload, self.content, payload * int(self.content))
+            self._touch()
+        return rendered[2]
+
+    def reset(self):
+        """Resets the incremental mode schedules of the block and of the data objects in it."""
+        apObject.reset(self)
+        self.container.reset()
+
+
 class apSocket:
     """apSocket is a wrapper class for the Python socket API, for specialized use with the antiparser.
 
@@ -802,11 +2103,29 @@ class apSocket:
            specified, than the default type is 'tcp'.
         """
         self.type = type
+        self.stats = None  # apStats that socket operations are recorded in, see setStats()
+        self.monitor = None  # apMonitor that sendCase() results are checked by
+        self.case = 0  # index of the next sendCase()
+        self.recvBuffer = bytearray(4096)  # receive buffer of recvUntil() and friends, grown as needed
+        self.recvStart = 0  # unread data sits in recvBuffer[recvStart:recvEnd]
+        self.recvEnd = 0
         if self.type == 'udp':
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         else:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
+    def getStats(self):
+        """Returns the apStats the socket records its operations in, or None."""
+        return self.stats
+
+    def setStats(self, stats):
+        """Sets the apStats to record socket operations in, or None to stop recording.  Defaults to None.
+
+           The apStats times the "connect", "send" and "recv" phases, counts the bytes sent and
+           received, and counts failed operations as "refused", "resets", "timeouts" or "errors".
+        """
+        self.stats = stats
+
     def connect(self, host, port):
         """Alias for the socket.connect method, forming a TCP connection to host/port.
 
@@ -814,27 +2133,264 @@ class apSocket:
         """
         self.host = host
         self.port = port
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
         try:
             self.sock.connect((self.host, self.port))
         except socket.error as msg:
+            if stats is not None:
+                self.stats.count(_errorCounter(msg))
             print("Could not connect: ", msg)
+        else:
+            if stats is not None:
+                stats.time("connect", time.perf_counter() - start)
 
     def sendTCP(self, payload):
         """Alias for the socket.sendall method, will send the entire payload over the socket."""
-        self.sock.sendall(payload)
+        if self.stats is None:
+            self.sock.sendall(_toBuffer(payload))
+            return
+        payload = _toBuffer(payload)
+        start = time.perf_counter()
+        try:
+            self.sock.sendall(payload)
+        except OSError as error:
+            self.stats.count(_errorCounter(error))
+            raise
+        self.stats.time("send", time.perf_counter() - start)
+        self.stats.count("sent_bytes", memoryview(payload).nbytes)
 
     def sendUDP(self, payload, host, port):
         """Alias for the socket.sendto method.
 
            sendUDP will send packets to host, port until all bytes in payload are sent.
         """
-        self.sock.sendto(payload, (host, port))
+        if self.stats is None:
+            self.sock.sendto(_toBuffer(payload), (host, port))
+            return
+        start = time.perf_counter()
+        try:
+            sent = self.sock.sendto(_toBuffer(payload), (host, port))
+        except OSError as error:
+            self.stats.count(_errorCounter(error))
+            raise
+        self.stats.time("send", time.perf_counter() - start)
+        self.stats.count("sent_bytes", sent)
+
+    def sendParts(self, parts):
+        """Sends a list of payloads over the socket as one stream, like sendTCP(b"".join(parts)).
+
+           The parts are handed to the socket.sendmsg method for scatter/gather I/O, so they are never
+           copied into one buffer.  Falls back to one sendall per part where sendmsg isn't available.
+        """
+        views = [memoryview(_toBuffer(part)).cast('B') for part in parts]
+        if self.stats is not None:
+            (total, start) = (sum(view.nbytes for view in views), time.perf_counter())
+            try:
+                self.__sendViews(views)
+            except OSError as error:
+                self.stats.count(_errorCounter(error))
+                raise
+            self.stats.time("send", time.perf_counter() - start)
+            self.stats.count("sent_bytes", total)
+        else:
+            self.__sendViews(views)
+
+    def __sendViews(self, views):
+        if not hasattr(self.sock, "sendmsg"):
+            for view in views:
+                self.sock.sendall(view)
+            return
+        while views:
+            sent = self.sock.sendmsg(views)
+            # drop whatever went out and send the rest
+            while views and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            if views and sent:
+                views[0] = views[0][sent:]
 
     def recv(self, size):
-        """Alias for the socket.recv method, blocks until the number of bytes specified by size is read from the socket."""
-        data = self.sock.recv(size)
+        """Alias for the socket.recv method, blocks until the number of bytes specified by size is read from the socket.
+
+           Data left over in the receive buffer by recvUntil(), recvExactly() or recvLines() is
+           returned first.
+        """
+        if self.recvStart < self.recvEnd:
+            return self.__take(min(size, self.recvEnd - self.recvStart))
+        if self.stats is None:
+            return self.sock.recv(size)
+        start = time.perf_counter()
+        try:
+            data = self.sock.recv(size)
+        except OSError as error:
+            self.stats.count(_errorCounter(error))
+            raise
+        self.stats.time("recv", time.perf_counter() - start)
+        self.stats.count("received_bytes", len(data))
         return data
 
+    def recvUntil(self, terminator, timeout=None, maxSize=None):
+        """Returns the data up to and including terminator, ie: b"\\r\\n" for a line.
+
+           Data after the terminator stays in the receive buffer for the next call.  If the other
+           end closes the connection first, whatever was received is returned, b"" if nothing.  If
+           maxSize bytes arrive without a terminator, those are returned.  timeout is a deadline in
+           seconds for the whole call rather than for each read; socket.timeout is raised once it
+           passes, leaving the data received so far in the buffer.  A timeout of None falls back
+           to the timeout of the socket for each read.
+        """
+        return self.__until(_toBytes(terminator), self.__deadline(timeout), maxSize)
+
+    def recvExactly(self, size, timeout=None):
+        """Returns exactly size bytes, or fewer if the other end closes the connection first.
+
+           timeout is a deadline for the whole call, see recvUntil().
+        """
+        deadline = self.__deadline(timeout)
+        while self.recvEnd - self.recvStart < size:
+            if not self.__fill(deadline):
+                break
+        return self.__take(min(size, self.recvEnd - self.recvStart))
+
+    def recvLines(self, terminator="\r\n", timeout=None):
+        """Generator that yields each line received, terminator included, until the connection closes.
+
+           timeout is a deadline for the whole iteration, see recvUntil().
+        """
+        terminator = _toBytes(terminator)
+        deadline = self.__deadline(timeout)
+        while True:
+            line = self.__until(terminator, deadline, None)
+            if not line:
+                return
+            yield line
+
+    def recvReply(self, terminator, complete=None, timeout=None, maxSize=None):
+        """Returns a reply made up of one or more lines that end in terminator.
+
+           complete is called with the reply so far after each line and returns True once the
+           reply is whole, ie: on the last line of a multi-line FTP reply.  By default a reply is
+           a single line.  If the connection closes or maxSize bytes arrive first, whatever was
+           received is returned.  timeout is a deadline for the whole reply, see recvUntil(), and
+           once it passes the lines received so far are returned, or socket.timeout raised if
+           there are none.
+        """
+        terminator = _toBytes(terminator)
+        deadline = self.__deadline(timeout)
+        reply = b""
+        while True:
+            try:
+                line = self.__until(terminator, deadline, None if maxSize is None else maxSize - len(reply))
+            except socket.timeout:
+                if reply:
+                    return reply
+                raise
+            reply += line
+            if not line.endswith(terminator) or maxSize is not None and len(reply) >= maxSize:
+                return reply
+            if complete is None or complete(reply):
+                return reply
+
+    def __deadline(self, timeout):
+        if timeout is None:
+            return None
+        return time.monotonic() + timeout
+
+    def __until(self, terminator, deadline, maxSize):
+        searched = 0  # bytes of the unread data known not to hold the start of a terminator
+        while True:
+            # a terminator past maxSize doesn't count, the first maxSize bytes are returned instead
+            end = self.recvEnd if maxSize is None else min(self.recvEnd, self.recvStart + maxSize)
+            found = self.recvBuffer.find(terminator, self.recvStart + searched, end)
+            if found >= 0:
+                return self.__take(found + len(terminator) - self.recvStart)
+            pending = self.recvEnd - self.recvStart
+            if maxSize is not None and pending >= maxSize:
+                return self.__take(maxSize)
+            searched = max(pending - len(terminator) + 1, 0)
+            if not self.__fill(deadline):
+                return self.__take(pending)
+
+    def __take(self, size):
+        start = self.recvStart
+        view = memoryview(self.recvBuffer)
+        data = bytes(view[start:start + size])
+        view.release()
+        self.recvStart = start + size
+        if self.recvStart == self.recvEnd:
+            self.recvStart = self.recvEnd = 0
+        return data
+
+    def __fill(self, deadline):
+        """Reads whatever is available into the receive buffer, returns the number of bytes read, 0 at EOF."""
+        buffer = self.recvBuffer
+        if self.recvEnd == len(buffer):
+            if self.recvStart:
+                # move the unread data to the front of the buffer
+                pending = self.recvEnd - self.recvStart
+                buffer[:pending] = buffer[self.recvStart:self.recvEnd]
+                (self.recvStart, self.recvEnd) = (0, pending)
+            else:
+                buffer.extend(bytes(len(buffer)))
+        if deadline is not None:
+            left = deadline - time.monotonic()
+            if left <= 0 or not select.select([self.sock], [], [], left)[0]:
+                if self.stats is not None:
+                    self.stats.count("timeouts")
+                raise socket.timeout("timed out")
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+        view = memoryview(buffer)[self.recvEnd:]
+        try:
+            read = self.sock.recv_into(view)
+        except OSError as error:
+            if stats is not None:
+                stats.count(_errorCounter(error))
+            raise
+        finally:
+            view.release()
+        if stats is not None:
+            stats.time("recv", time.perf_counter() - start)
+            stats.count("received_bytes", read)
+        self.recvEnd += read
+        return read
+
+    def getMonitor(self):
+        """Returns the apMonitor that checks the results of sendCase(), or None."""
+        return self.monitor
+
+    def setMonitor(self, monitor):
+        """Sets the apMonitor that checks the results of sendCase(), or None.  Defaults to None."""
+        self.monitor = monitor
+
+    def sendCase(self, payload, size=1024, index=None, terminator=None, complete=None):
+        """Sends a fuzz case over TCP and reads up to size bytes of reply, returns an apResult.
+
+           Errors are recorded in the apResult rather than raised.  index defaults to one more than
+           the last case.  If a terminator is given, the reply is read with recvReply() instead of
+           a single recv(), up to size bytes.  If an apMonitor is set, the result is checked by it.
+        """
+        if index is None:
+            index = self.case
+        self.case = index + 1
+        result = apResult(index)
+        start = time.perf_counter()
+        try:
+            self.sendTCP(payload)
+            if terminator is None:
+                result.response = self.recv(size)
+            else:
+                result.response = self.recvReply(terminator, complete, maxSize=size)
+            result.latency = time.perf_counter() - start
+        except OSError as err:
+            result.error = err.__class__.__name__
+        if self.monitor is not None:
+            self.monitor.check(result, payload)
+        return result
+
     def replayTCP(self, fileName):
         """Sends a permutation of the antiparser that was previously saved over TCP, as specified by fileName.
 
@@ -855,10 +2411,1193 @@ class apSocket:
         ap.load(fileName)
         self.sendUDP(ap.getPayload(), host, port)
 
+    def replayCorpusTCP(self, corpus, index):
+        """Sends case index of an apCorpusReader over TCP, straight from the memory mapped corpus file."""
+        self.sendTCP(corpus[index])
+
+    def replayCorpusUDP(self, corpus, index, host, port):
+        """Sends case index of an apCorpusReader over UDP, straight from the memory mapped corpus file."""
+        self.sendUDP(corpus[index], host, port)
+
+    def setTimeout(self, secs):
+        """Alias for the socket.settimeout method, None makes socket operations block forever."""
+        self.sock.settimeout(secs)
+
+    def isAlive(self):
+        """Returns False if the other end has closed the connection.
+
+           isAlive() never blocks.  Any data waiting to be read is left on the socket.
+        """
+        try:
+            if not select.select([self.sock], [], [], 0)[0]:
+                return True
+            return self.sock.recv(1, socket.MSG_PEEK) != b""
+        except (OSError, ValueError):
+            return False
+
     def sleep(self, secs):
-        """Alias for time.sleep, sleeps for the number of seconds specified by the secs argument."""
+        """Alias for time.sleep, sleeps for the number of seconds specified by the secs argument.
+
+           See apPacer for pacing cases to what the target can take instead.
+        """
         time.sleep(secs)
 
     def close(self):
         """Alias for socket.close method.  This closes the existing socket."""
         self.sock.close()
+
+
+class apResult:
+    """apResult records the outcome of sending one fuzz case to a target.
+
+       index is the case index, response holds the bytes the target sent back after the payload,
+       latency is the number of seconds between sending the payload and receiving the response,
+       and error is the name of the exception that ended the exchange, or None.  outcome is the
+       classification of the case by an apMonitor, and novel is True if it made a new bucket.
+    """
+
+    def __init__(self, index, response=b"", latency=None, error=None):
+        self.index = index
+        self.response = response
+        self.latency = latency
+        self.error = error
+        self.outcome = None  # set by apMonitor.check()
+        self.novel = False
+
+    def __repr__(self):
+        return "apResult(%r, %r, %r, %r)" % (self.index, self.response, self.latency, self.error)
+
+
+class apMonitor:
+    """apMonitor classifies the apResult of each fuzz case and buckets similar outcomes together.
+
+       check() sets the outcome of a result to one of "refused", "reset", "timeout" or "error" if
+       the case ended with an error, "closed" if the target sent nothing back, "code" if the
+       response code, such as the "500" of an FTP reply, differs from the one of the case before,
+       "slow" if the latency is more than latencyFactor standard deviations above the mean of the
+       cases so far and longer than latencyFloor seconds, or "ok".  Results are then bucketed by
+       their outcome, error and a cheap hash of the start of the response with digits after the
+       response code blanked out, so a million identical "500 Syntax error" replies make a single
+       bucket with a count of a million.  Only the first result and payload of each bucket are
+       kept, and once there are maxBuckets buckets new ones are only counted, so memory stays
+       bounded during long runs.
+    """
+
+    def __init__(self, latencyFactor=4.0, latencyFloor=0.01, warmup=32, maxBuckets=4096):
+        self.latencyFactor = latencyFactor
+        self.latencyFloor = latencyFloor  # so jitter of a very fast target doesn't count as slow
+        self.warmup = warmup  # number of latencies to see before any case counts as slow
+        self.maxBuckets = maxBuckets
+        self.buckets = {}  # (outcome, error, response hash): [count, first apResult, its payload]
+        self.overflow = 0  # number of cases that would have made a new bucket past maxBuckets
+        self.cases = 0
+        self.code = None  # response code of the last case
+        self.latencies = [0, 0.0, 0.0]  # count, mean and sum of squared deviations (Welford)
+
+    def check(self, result, payload=None):
+        """Classifies and buckets result, returns True and sets result.novel if it made a new bucket.
+
+           A new bucket is a novel outcome, which is worth keeping the payload of, ie: with
+           apCorpusWriter.  payload is kept in the bucket as bytes.
+        """
+        self.cases += 1
+        response = result.response or b""
+        if result.error is not None:
+            outcome = _OUTCOMES.get(result.error, "error")
+        elif not response:
+            outcome = "closed"
+        else:
+            outcome = "ok"
+            match = _RESPONSECODE.match(response)
+            code = match.group(1) if match else None
+            if code != self.code and self.code is not None:
+                outcome = "code"
+            self.code = code
+            if result.latency is not None and self.__isSlow(result.latency) and outcome == "ok":
+                outcome = "slow"
+        result.outcome = outcome
+        head = response[:_BUCKETPREFIX]
+        key = (outcome, result.error, zlib.crc32(_DIGITS.sub(b"0", head[3:]), zlib.crc32(head[:3])))
+        bucket = self.buckets.get(key)
+        if bucket is not None:
+            bucket[0] += 1
+            return False
+        if len(self.buckets) >= self.maxBuckets:
+            self.overflow += 1
+            return False
+        self.buckets[key] = [1, result, None if payload is None else _toBytes(payload)]
+        result.novel = True
+        return True
+
+    def __isSlow(self, latency):
+        (count, mean, squares) = self.latencies
+        slow = (count >= self.warmup and latency > self.latencyFloor and
+                latency > mean + self.latencyFactor * (squares / count) ** 0.5)
+        if not slow:
+            # outliers are left out so that they don't drag the mean up
+            count += 1
+            delta = latency - mean
+            mean += delta / count
+            squares += delta * (latency - mean)
+            self.latencies = [count, mean, squares]
+        return slow
+
+    def getBuckets(self):
+        """Returns a list of (count, first apResult, payload) for every bucket, least common first."""
+        return sorted(([count, result, payload] for (count, result, payload) in self.buckets.values()),
+                      key=lambda bucket: (bucket[0], bucket[1].index))
+
+    def display(self):
+        """Prints a summary of the buckets."""
+        print("++ %s cases in %s buckets ++" % (self.cases, len(self.buckets)))
+        for (count, result, payload) in self.getBuckets():
+            print("%8d  %-8s case %-8s %r" % (count, result.outcome, result.index,
+                                             result.error or result.response[:_BUCKETPREFIX]))
+        if self.overflow:
+            print("++ %s cases did not fit in %s buckets ++" % (self.overflow, self.maxBuckets))
+
+
+class apPacer:
+    """apPacer paces fuzz cases to a target with a token bucket that adapts to how the target copes.
+
+       Call wait() before each case and done() with its apResult afterwards.  rate is the number
+       of cases per second, up to burst of which may go out back to back, and None leaves the
+       cases unpaced until the target first struggles.  At most concurrency cases are let through
+       wait() at once, None for no limit.  When a case is refused, reset or times out, or its
+       latency is more than latencyFactor times the usual latency, the rate is multiplied by
+       backoff, at most once per cooldown seconds and never below minRate.  Every case that goes
+       well adds recovery to the rate, up to maxRate, so the pace picks up again once the target
+       settles down.  Use one apPacer per target, it may be shared between threads.
+    """
+
+    def __init__(self, rate=None, burst=1, concurrency=None, minRate=0.1, maxRate=None, backoff=0.5,
+                 recovery=0.1, latencyFactor=3.0, cooldown=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.minRate = minRate
+        self.maxRate = maxRate
+        self.backoff = backoff
+        self.recovery = recovery
+        self.latencyFactor = latencyFactor
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.slots = None if concurrency is None else threading.BoundedSemaphore(concurrency)
+        self.tokens = burst
+        self.last = time.monotonic()  # when the tokens were last topped up
+        self.interval = None  # moving average of the time between cases, for the rate of an unpaced target
+        self.latency = None  # moving average of the latency of cases that went well
+        self.backedOff = None  # when the rate was last cut
+
+    def getRate(self):
+        """Returns the current rate in cases per second, or None if cases are unpaced."""
+        return self.rate
+
+    def setRate(self, rate):
+        """Sets the current rate in cases per second, or None to stop pacing cases."""
+        with self.lock:
+            self.rate = rate
+
+    def wait(self):
+        """Blocks until the next case may be sent."""
+        if self.slots is not None:
+            self.slots.acquire()
+        delay = self.__reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def waitAsync(self):
+        """Coroutine version of wait() for apAsyncRunner, which limits its concurrency by itself.
+
+           Cases that went through waitAsync() take no concurrency slot, so report them with
+           adapt() rather than done().
+        """
+        delay = self.__reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def __reserve(self):
+        """Takes a token for the next case and returns how long to wait for it."""
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.last
+            self.last = now
+            if self.interval is None:
+                self.interval = elapsed
+            else:
+                self.interval += (elapsed - self.interval) * 0.05
+            if self.rate is None:
+                return 0
+            self.tokens = min(self.tokens + elapsed * self.rate, self.burst) - 1
+            if self.tokens >= 0:
+                return 0
+            # the token is taken up front, so that cases waiting at the same time queue up
+            return -self.tokens / self.rate
+
+    def done(self, result=None):
+        """Records the apResult of a case that went through wait() and adapts the rate to it."""
+        if self.slots is not None:
+            self.slots.release()
+        if result is not None:
+            self.adapt(result)
+
+    def adapt(self, result):
+        """Adapts the rate to the apResult of a case, without giving back its concurrency slot.
+
+           Slow cases are folded into the usual latency too, at a lower weight, so that a target
+           that settles at a higher latency stops counting as struggling.
+        """
+        latency = result.latency
+        struggling = _OUTCOMES.get(result.error) in ("refused", "reset", "timeout")
+        with self.lock:
+            if not struggling and latency is not None:
+                if self.latency is not None and latency > self.latency * self.latencyFactor:
+                    struggling = True
+                    self.latency += (latency - self.latency) * 0.01
+                elif self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += (latency - self.latency) * 0.05
+            now = time.monotonic()
+            if struggling:
+                if self.backedOff is not None and now - self.backedOff < self.cooldown:
+                    return
+                self.backedOff = now
+                rate = self.rate
+                if rate is None:
+                    # start pacing from the rate cases have been going out at
+                    rate = 1 / self.interval if self.interval else self.minRate / self.backoff
+                self.rate = max(rate * self.backoff, self.minRate)
+                self.tokens = min(self.tokens, 0)
+                _log.debug("++ Target is struggling, backing off to %.2f cases per second ++", self.rate)
+            elif self.rate is not None and result.error is None:
+                self.rate += self.recovery
+                if self.maxRate is not None and self.rate > self.maxRate:
+                    self.rate = self.maxRate
+
+
+class apAsyncSocket:
+    """apAsyncSocket is the asyncio counterpart of apSocket for TCP connections.
+
+       Every operation is a coroutine and is bounded by the timeout given to the constructor, in
+       seconds.  A timeout of None waits forever.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host, port):
+        """Opens a TCP connection to host/port."""
+        self.host = host
+        self.port = port
+        (self.reader, self.writer) = await asyncio.wait_for(asyncio.open_connection(host, port), self.timeout)
+
+    async def sendTCP(self, payload):
+        """Sends the entire payload over the connection."""
+        self.writer.write(_toBuffer(payload))
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+    async def recv(self, size):
+        """Returns up to size bytes from the connection, or b"" once the target has closed it."""
+        return await asyncio.wait_for(self.reader.read(size), self.timeout)
+
+    async def close(self):
+        """Closes the connection."""
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.writer = None
+
+
+class apAsyncRunner:
+    """apAsyncRunner sends fuzz cases to a TCP target over many concurrent connections.
+
+       Each case gets its own connection: the runner connects, reads the banner, sends each line of
+       the preamble (such as FTP USER/PASS commands), sends the payload and reads the response.
+       Up to concurrency cases are in flight at once, and every step is bounded by timeout seconds.
+       If pipeline is True, the preamble and the payload are written back to back in a single send
+       after the banner, and the response then holds the replies to all of them.
+    """
+
+    def __init__(self, host, port, concurrency=64, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.bannerSize = 10240  # bytes to read for the banner, 0 if the target sends none
+        self.recvSize = 10240
+        self.preamble = []
+        self.pipeline = False
+        self.pacer = None
+
+    def setPacer(self, pacer):
+        """Sets the apPacer that paces the cases, or None to send them as fast as possible."""
+        self.pacer = pacer
+
+    def setPreamble(self, preamble):
+        """Sets the list of payloads to send on each connection before the fuzz case."""
+        self.preamble = [_toBytes(line) for line in preamble]
+
+    def setBannerSize(self, size):
+        """Sets the number of bytes of banner to read after connecting, 0 to not read a banner."""
+        self.bannerSize = size
+
+    def setRecvSize(self, size):
+        """Sets the maximum number of bytes read for each reply."""
+        self.recvSize = size
+
+    def setPipeline(self, pipeline):
+        """Sets whether the preamble and payload are pipelined in one send, see apAsyncRunner."""
+        self.pipeline = pipeline
+
+    def run(self, payloads, callback=None):
+        """Sends every payload in the payloads iterable and returns a list of apResult, ordered by index.
+
+           If a callback is given, it is called with each apResult as soon as its case completes and
+           the results are not kept, so that long runs use constant memory.
+        """
+        return asyncio.run(self.runAsync(payloads, callback))
+
+    async def runAsync(self, payloads, callback=None):
+        """Coroutine version of run() for callers that already have an event loop."""
+        cases = enumerate(payloads)
+        results = []
+        if callback is None:
+            callback = results.append
+        workers = [self.__worker(cases, callback) for i in range(self.concurrency)]
+        await asyncio.gather(*workers)
+        results.sort(key=lambda result: result.index)
+        return results
+
+    async def __worker(self, cases, callback):
+        # the event loop is single threaded, so the workers can share the iterator
+        for (index, payload) in cases:
+            if self.pacer is None:
+                callback(await self.__case(index, payload))
+                continue
+            await self.pacer.waitAsync()
+            result = await self.__case(index, payload)
+            self.pacer.adapt(result)
+            callback(result)
+
+    async def __case(self, index, payload):
+        result = apResult(index)
+        sock = apAsyncSocket(self.timeout)
+        try:
+            await sock.connect(self.host, self.port)
+            if self.bannerSize:
+                await sock.recv(self.bannerSize)
+            if self.pipeline:
+                start = time.perf_counter()
+                await sock.sendTCP(b"".join(self.preamble) + _toBytes(payload))
+            else:
+                for line in self.preamble:
+                    await sock.sendTCP(line)
+                    await sock.recv(self.recvSize)
+                start = time.perf_counter()
+                await sock.sendTCP(payload)
+            result.response = await sock.recv(self.recvSize)
+            result.latency = time.perf_counter() - start
+        except (OSError, asyncio.TimeoutError) as err:
+            result.error = err.__class__.__name__
+        finally:
+            await sock.close()
+        return result
+
+
+class apSession:
+    """apSession sends many fuzz payloads over a pool of connections that have each been set up once.
+
+       A session is a template for a stateful protocol: a scripted preamble, such as reading the
+       banner and logging in, is built with addRecv() and addSend() and run once on each new
+       connection.  send() then reuses an idle connection from the pool for each payload.  A pooled
+       connection that the target has closed in the meantime is detected before the payload goes
+       out and is replaced with a new one, preamble and all.  Up to size idle connections are kept,
+       and the pool may be shared between threads.
+    """
+
+    def __init__(self, host, port, size=1, timeout=None):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.preamble = []  # (payload, size) steps, payload is None for a plain read
+        self.pool = queue.LifoQueue()
+        self.stats = None  # apStats handed to every new connection, see apSocket.setStats()
+        self.terminator = None  # replies are read with apSocket.recvReply() if set, see setReply()
+        self.complete = None
+
+    def setStats(self, stats):
+        """Sets the apStats that connections opened from now on record their operations in."""
+        self.stats = stats
+
+    def setReply(self, terminator, complete=None):
+        """Reads replies as lines ending in terminator rather than with a single recv, see apSocket.recvReply().
+
+           Every read of the session, in the preamble as well as in send(), then returns whole
+           replies of up to size bytes, each bounded by the timeout of the session as a whole.
+           complete tells when a multi-line reply is whole.  A terminator of None goes back to a
+           single recv of up to size bytes.
+        """
+        self.terminator = None if terminator is None else _toBytes(terminator)
+        self.complete = complete
+
+    def __read(self, sock, size):
+        if self.terminator is None:
+            return sock.recv(size)
+        return sock.recvReply(self.terminator, self.complete, self.timeout, size)
+
+    def addRecv(self, size):
+        """Adds a step to the preamble that reads up to size bytes, such as a banner."""
+        self.preamble.append((None, size))
+
+    def addSend(self, payload, size=None):
+        """Adds a step to the preamble that sends payload and then reads up to size bytes of reply.
+
+           If size is None the step doesn't wait for a reply.
+        """
+        self.preamble.append((_toBytes(payload), size))
+
+    def connect(self):
+        """Opens a new connection and runs the preamble on it.  Returns the apSocket."""
+        sock = apSocket()
+        sock.setTimeout(self.timeout)
+        sock.setStats(self.stats)
+        if self.stats is not None:
+            start = time.perf_counter()
+        try:
+            try:
+                sock.sock.connect((self.host, self.port))
+            except OSError as error:
+                if self.stats is not None:
+                    self.stats.count(_errorCounter(error))
+                raise
+            if self.stats is not None:
+                self.stats.time("connect", time.perf_counter() - start)
+            for (payload, size) in self.preamble:
+                if payload is not None:
+                    sock.sendTCP(payload)
+                if size is not None:
+                    self.__read(sock, size)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def acquire(self):
+        """Returns a live connection from the pool, or a new one if there are no idle connections."""
+        sock = self.__takeIdle()
+        if sock is None:
+            sock = self.connect()
+        return sock
+
+    def __takeIdle(self):
+        while True:
+            try:
+                sock = self.pool.get_nowait()
+            except queue.Empty:
+                return None
+            if sock.isAlive():
+                # throw away anything left over from the last payload
+                sock.recvStart = sock.recvEnd = 0
+                try:
+                    while select.select([sock.sock], [], [], 0)[0]:
+                        if sock.sock.recv(65536) == b"":
+                            break
+                    else:
+                        return sock
+                except OSError:
+                    pass  # reset while draining, throw the connection away
+            sock.close()
+
+    def release(self, sock):
+        """Returns a connection to the pool, closing it if the pool is full."""
+        if self.pool.qsize() < self.size:
+            self.pool.put(sock)
+        else:
+            sock.close()
+
+    def send(self, payload, size=1024):
+        """Sends payload over a pooled connection and returns up to size bytes of the reply.
+
+           The target may close an idle connection just as it is reused, so if a reused connection
+           dies the payload is sent once more over a new connection.  A new connection that dies
+           is dropped rather than returned to the pool, and whatever reply was read, usually b"",
+           is returned so the caller can tell that the payload killed it.  A payload that times
+           out is never sent again, since it may well be what hung the target: the connection is
+           dropped and socket.timeout raised.
+        """
+        sock = self.__takeIdle()
+        reused = sock is not None
+        while True:
+            if sock is None:
+                sock = self.connect()
+            try:
+                sock.sendTCP(payload)
+                reply = self.__read(sock, size)
+            except socket.timeout:
+                sock.close()
+                raise
+            except OSError:
+                reply = b""
+            if reply != b"":
+                self.release(sock)
+                return reply
+            sock.close()
+            if not reused:
+                return reply
+            (sock, reused) = (None, False)
+
+    def close(self):
+        """Closes every idle connection in the pool."""
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class apHarness:
+    """apHarness feeds the payloads of an antiparser straight into a Python callable.
+
+       The harness is for fuzzing parsers written in Python without any socket or file I/O: each
+       payload is passed to target as bytes, in batches of batchSize generated with payloadAt().
+       If the antiparser has no seed, a random one is set first, so that the index of every
+       failing case can be replayed with payloadAt().  Only failing cases are recorded, as an
+       apResult whose error is the name of the exception target raised, or "timeout" if target
+       ran for longer than timeout seconds.  target runs in a worker thread watched by the
+       calling thread, and since a Python thread cannot be killed, a worker that times out is
+       abandoned and a new one carries on with the next case.
+    """
+
+    def __init__(self, template, target, timeout=None, batchSize=256):
+        self.template = template
+        self.target = target
+        self.timeout = timeout
+        self.batchSize = batchSize
+        self.cases = 0  # number of cases run
+        self.lock = threading.Lock()
+        self.worker = None  # token of the worker thread that is currently running cases
+        self.current = None  # (case index, start time) of the case target is running
+        self.remaining = 0
+        self.next = 0  # index of the next case to generate
+        self.failure = None  # exception raised by a worker outside of target
+
+    def run(self, count, callback=None):
+        """Runs count cases and returns a list of apResult for the failing ones, ordered by index.
+
+           If a callback is given, it is called with each apResult as soon as its case fails and the
+           results are not kept.  Cases carry on from the last case of the antiparser.
+        """
+        results = []
+        if callback is None:
+            callback = results.append
+        if self.template.getSeed() is None:
+            self.template.setSeed(random.getrandbits(64))
+        self.remaining = count
+        self.next = self.template.getCase()
+        self.failure = None
+        done = threading.Event()
+        interval = None if self.timeout is None else min(self.timeout / 4, 0.1)
+        while self.remaining > 0:
+            token = object()
+            with self.lock:
+                self.worker = token
+                self.current = None
+            done.clear()
+            thread = threading.Thread(target=self.__work, args=(token, callback, done))
+            thread.daemon = True
+            thread.start()
+            while not done.wait(interval):
+                with self.lock:
+                    current = self.current
+                    if current is None or time.monotonic() - current[1] < self.timeout:
+                        continue
+                    # give up on the worker, it is left to finish in the background
+                    self.worker = None
+                    self.current = None
+                    self.remaining -= 1
+                    self.cases += 1
+                    self.next = current[0] + 1
+                callback(apResult(current[0], latency=time.monotonic() - current[1], error="timeout"))
+                break
+            if self.failure is not None:
+                raise self.failure
+        results.sort(key=lambda result: result.index)
+        return results
+
+    def __work(self, token, callback, done):
+        template = self.template
+        target = self.target
+        stats = template.getStats()
+        try:
+            while True:
+                with self.lock:
+                    if self.worker is not token or self.remaining <= 0:
+                        return
+                    batch = min(self.remaining, self.batchSize)
+                first = self.next
+                payloads = [template.payloadAt(index) for index in range(first, first + batch)]
+                for (index, payload) in enumerate(payloads, first):
+                    start = time.perf_counter()
+                    self.current = (index, time.monotonic())
+                    error = None
+                    try:
+                        target(payload)
+                    except Exception as err:
+                        error = err.__class__.__name__
+                    latency = time.perf_counter() - start
+                    with self.lock:
+                        if self.worker is not token:
+                            return  # the watchdog gave up on this case
+                        self.current = None
+                        self.remaining -= 1
+                        self.cases += 1
+                        self.next = index + 1
+                    if stats is not None:
+                        stats.time("target", latency)
+                    if error is not None:
+                        callback(apResult(index, latency=latency, error=error))
+        except Exception as err:
+            self.failure = err
+        finally:
+            with self.lock:
+                if self.worker is token:
+                    self.worker = None
+                    done.set()
+
+
+# apProcessPool control frames: each case is announced to the target with the length of the payload
+# as a 32-bit little endian integer, followed by the payload itself if it is delivered over stdin.
+# The target writes one byte to stdout once it is done with the case.
+_FRAME = struct.Struct('<I')
+
+
+class _apTarget:
+    """One long-lived target process of an apProcessPool."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.process = None
+        self.fd = None  # file descriptor of the file payloads are delivered in, for "file" delivery
+        self.path = None
+
+    def start(self):
+        passFds = ()
+        if self.pool.delivery == "file":
+            if self.fd is None and hasattr(os, "memfd_create"):
+                self.fd = os.memfd_create("apcase")
+                self.path = "/dev/fd/%d" % self.fd
+            elif self.fd is None:
+                # tmpfs keeps the payload in memory where there is one
+                (self.fd, self.path) = tempfile.mkstemp(prefix="apcase", dir="/dev/shm" if os.path.isdir("/dev/shm")
+                                                        else None)
+            if self.path.startswith("/dev/fd/"):
+                passFds = (self.fd,)
+        command = [self.path if arg == "@@" else arg for arg in self.pool.command]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, pass_fds=passFds)
+        os.set_blocking(self.process.stdin.fileno(), False)
+
+    def deliver(self, payload, timeout):
+        """Runs one case, returns (error, latency), where error is None if the target acknowledged it."""
+        if self.process is None:
+            self.start()
+        payload = memoryview(_toBuffer(payload)).cast('B')
+        if self.fd is not None:
+            os.pwrite(self.fd, payload, 0)
+            os.ftruncate(self.fd, payload.nbytes)
+            parts = [_FRAME.pack(payload.nbytes)]
+        else:
+            parts = [_FRAME.pack(payload.nbytes), payload]
+        start = time.perf_counter()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            done = self.__send(parts, deadline) and self.__acknowledge(deadline)
+        except OSError:
+            done = None  # the pipe broke, the target is gone
+        latency = time.perf_counter() - start
+        if done:
+            return (None, latency)
+        if done is False and self.process.poll() is None:
+            error = "timeout"
+            self.process.kill()
+        else:
+            error = None
+        try:
+            status = self.process.wait(1)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            status = self.process.wait()
+        if error is None:
+            if status < 0:
+                try:
+                    error = signal.Signals(-status).name
+                except ValueError:
+                    error = "signal %d" % -status
+            else:
+                error = "exit %d" % status
+        self.stop()
+        with self.pool.lock:
+            self.pool.restarts += 1
+        return (error, latency)
+
+    def __send(self, parts, deadline):
+        fd = self.process.stdin.fileno()
+        views = list(parts)
+        while views:
+            if not select.select([], [fd], [], self.__left(deadline))[1]:
+                return False
+            try:
+                written = os.writev(fd, views)
+            except BlockingIOError:
+                continue
+            while views and written >= len(views[0]):
+                written -= len(views[0])
+                views.pop(0)
+            if views and written:
+                views[0] = memoryview(views[0])[written:]
+        return True
+
+    def __acknowledge(self, deadline):
+        fd = self.process.stdout.fileno()
+        if not select.select([fd], [], [], self.__left(deadline))[0]:
+            return False
+        if os.read(fd, 1) == b"":
+            return None  # the target exited
+        return True
+
+    def __left(self, deadline):
+        if deadline is None:
+            return None
+        return max(deadline - time.monotonic(), 0)
+
+    def stop(self):
+        """Closes the pipes of the process, and kills it if it doesn't exit by itself."""
+        if self.process is None:
+            return
+        for pipe in (self.process.stdin, self.process.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        try:
+            self.process.wait(1)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def close(self):
+        self.stop()
+        if self.fd is not None:
+            os.close(self.fd)
+            if not self.path.startswith("/dev/fd/"):
+                os.unlink(self.path)
+            self.fd = None
+
+
+class apProcessPool:
+    """apProcessPool runs fuzz cases through a pool of long-lived local target processes.
+
+       command is the argument list of the target, which is started once per worker and then
+       sent case after case, so that process start up is paid once per worker rather than once
+       per case.  The target is expected to loop: read a 32-bit little endian payload length
+       from stdin, read the payload, process it and write one byte to stdout.  With delivery set
+       to "stdin" the payload follows its length on stdin.  With delivery set to "file" only the
+       length is sent, and the payload is written to a memfd, or a file on tmpfs where memfd
+       isn't available, whose path replaces any "@@" argument in command.
+
+       A case fails if the target dies while on it, which is recorded with the name of the
+       signal, ie: "SIGSEGV", or as "exit N", or if it doesn't acknowledge the case within
+       timeout seconds, in which case it is killed and recorded as "timeout".  Either way the
+       worker is restarted for the next case.
+    """
+
+    def __init__(self, command, workers=1, timeout=5.0, delivery="stdin"):
+        if delivery not in ("stdin", "file"):
+            raise ValueError("Unknown delivery %r, expected 'stdin' or 'file'" % delivery)
+        self.command = list(command)
+        self.timeout = timeout
+        self.delivery = delivery
+        self.cases = 0  # number of cases run
+        self.restarts = 0  # number of times a worker was restarted after a failed case
+        self.lock = threading.Lock()
+        self.targets = [_apTarget(self) for i in range(workers)]
+
+    def run(self, payloads, callback=None):
+        """Runs every payload in the payloads iterable and returns a list of apResult for the failing ones.
+
+           The results are ordered by index.  If a callback is given, it is called from the worker
+           threads with each apResult as soon as its case fails, and the results are not kept.
+        """
+        results = []
+        if callback is None:
+            callback = results.append
+        cases = enumerate(payloads)
+        errors = []
+        threads = [threading.Thread(target=self.__work, args=(target, cases, callback, errors))
+                   for target in self.targets]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        results.sort(key=lambda result: result.index)
+        return results
+
+    def __work(self, target, cases, callback, errors):
+        try:
+            while True:
+                with self.lock:
+                    if errors:
+                        return
+                    try:
+                        (index, payload) = next(cases)
+                    except StopIteration:
+                        return
+                (error, latency) = target.deliver(payload, self.timeout)
+                with self.lock:
+                    self.cases += 1
+                if error is not None:
+                    callback(apResult(index, latency=latency, error=error))
+        except Exception as err:
+            with self.lock:
+                errors.append(err)
+
+    def close(self):
+        """Stops every target process."""
+        for target in self.targets:
+            target.close()
+
+
+# corpus files start with a magic string and format version, each record is a 32-bit little endian
+# length followed by the payload.  The index file holds the 64-bit offset of every record.
+_CORPUS_MAGIC = b"APCORPUS\x01"
+_INDEX_MAGIC = b"APINDEX\x01\x00"
+_RECORD = struct.Struct('<I')
+_OFFSET = struct.Struct('<Q')
+
+
+class apCorpusWriter:
+    """apCorpusWriter streams payloads into an append-only corpus file.
+
+       A corpus keeps any number of payloads in one file, plus an index file of record offsets
+       named after it with an ".idx" extension, instead of one pickle per permutation.  Payloads
+       are appended to an existing corpus.  Use apCorpusReader to read the cases back.
+    """
+
+    def __init__(self, fileName, bufferSize=1 << 20):
+        self.fileName = fileName
+        (directory, name) = os.path.split(fileName)
+        if not (os.path.isdir(directory) or directory == ""):
+            os.mkdir(directory, 0o700)
+        self.data = open(fileName, 'ab', bufferSize)
+        self.index = open(fileName + ".idx", 'ab', bufferSize)
+        if self.data.tell() == 0:
+            self.data.write(_CORPUS_MAGIC)
+        if self.index.tell() == 0:
+            self.index.write(_INDEX_MAGIC)
+        self.offset = self.data.tell()
+        self.count = (self.index.tell() - len(_INDEX_MAGIC)) // _OFFSET.size
+
+    def __len__(self):
+        return self.count
+
+    def write(self, payload):
+        """Appends a payload, such as antiparser.getPayloadView(), to the corpus and returns its case index."""
+        payload = _toBuffer(payload)
+        length = memoryview(payload).nbytes
+        self.data.write(_RECORD.pack(length))
+        self.data.write(payload)
+        self.index.write(_OFFSET.pack(self.offset))
+        self.offset += _RECORD.size + length
+        self.count += 1
+        return self.count - 1
+
+    def flush(self):
+        """Flushes buffered payloads to disk so that readers can see them."""
+        self.data.flush()
+        self.index.flush()
+
+    def close(self):
+        """Flushes and closes the corpus."""
+        self.data.close()
+        self.index.close()
+
+
+class apCorpusReader:
+    """apCorpusReader gives random access to the payloads in a corpus written by apCorpusWriter.
+
+       Both the corpus and its index are memory mapped, so reading a case makes no copy:
+       corpus[index] is a memoryview of the payload inside the mapping, which can be passed
+       straight to apSocket.sendTCP() or apSocket.replayCorpusTCP().  The reader sees the cases
+       that were written when it was opened.
+    """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.data = self.__map(fileName, _CORPUS_MAGIC)
+        self.index = self.__map(fileName + ".idx", _INDEX_MAGIC)
+        self.count = (len(self.index) - len(_INDEX_MAGIC)) // _OFFSET.size
+        self.view = memoryview(self.data)
+
+    def __map(self, fileName, magic):
+        infile = open(fileName, 'rb')
+        try:
+            mapping = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            infile.close()
+        if mapping[:len(magic)] != magic:
+            mapping.close()
+            raise ValueError("%s is not an antiparser corpus file" % fileName)
+        return mapping
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        index = range(self.count)[index]  # negative indexes and IndexError
+        offset = _OFFSET.unpack_from(self.index, len(_INDEX_MAGIC) + _OFFSET.size * index)[0]
+        length = _RECORD.unpack_from(self.data, offset)[0]
+        start = offset + _RECORD.size
+        return self.view[start:start + length]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def close(self):
+        """Unmaps the corpus.  Views returned by the reader must be released first."""
+        self.view.release()
+        self.data.close()
+        self.index.close()
+
+
+class apFileWriter:
+    """apFileWriter writes payloads to files from a background thread.
+
+       target is a directory, which is created if needed, or a tar or zip archive.  The format is
+       "dir", "tar" or "zip", and is worked out from the extension of target if not given.  write()
+       queues a payload and returns straight away, so payload generation and disk I/O overlap;
+       close() waits for the queue to drain and raises any error the writer thread ran into.
+    """
+
+    def __init__(self, target, format=None, bufferSize=1 << 20, depth=64):
+        if format is None:
+            if target.endswith(".tar"):
+                format = "tar"
+            elif target.endswith(".zip"):
+                format = "zip"
+            else:
+                format = "dir"
+        self.target = target
+        self.format = format
+        self.bufferSize = bufferSize
+        self.error = None
+        self.queue = queue.Queue(depth)
+        if format == "dir":
+            if not os.path.isdir(target):
+                os.makedirs(target, 0o700)
+            self.archive = None
+        else:
+            outfile = open(target, 'wb', bufferSize)
+            if format == "tar":
+                self.archive = tarfile.open(fileobj=outfile, mode='w')
+            else:
+                self.archive = zipfile.ZipFile(outfile, 'w', zipfile.ZIP_STORED)
+            self.outfile = outfile
+        self.thread = threading.Thread(target=self.__run, name="apFileWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, name, payload):
+        """Queues payload to be written to the file name.
+
+           payload is a byte string or a list of byte strings that are written one after the other.
+           The payload must not change after it is queued, so pass getPayload() rather than
+           getPayloadView().
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((name, payload))
+
+    def close(self):
+        """Writes out every queued payload and closes the target."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.archive is not None:
+            self.archive.close()
+            self.outfile.close()
+        if self.error is not None:
+            raise self.error
+
+    def __run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            if self.error is not None:
+                continue  # keep draining so that write() never blocks forever
+            try:
+                self.__write(*job)
+            except Exception as err:  # anything else would kill the thread and leave write() blocked
+                self.error = err
+
+    def __write(self, name, payload):
+        if isinstance(payload, (list, tuple)):
+            parts = [_toBuffer(part) for part in payload]
+        else:
+            parts = [_toBuffer(payload)]
+        if self.format == "dir":
+            fd = os.open(os.path.join(self.target, name), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                _writeAll(fd, parts)
+            finally:
+                os.close(fd)
+        elif self.format == "tar":
+            data = b"".join(parts)
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            self.archive.addfile(info, io.BytesIO(data))
+        else:
+            self.archive.writestr(name, b"".join(parts))
+
+
+def _writeAll(fd, parts):
+    """Writes a list of byte strings to a file descriptor, with os.writev where it is available."""
+    views = [memoryview(part).cast('B') for part in parts]
+    while views:
+        if hasattr(os, "writev"):
+            written = os.writev(fd, views)
+        else:
+            written = os.write(fd, views[0])
+        while views and written >= len(views[0]):
+            written -= len(views[0])
+            views.pop(0)
+        if views and written:
+            views[0] = views[0][written:]
+
+
+class apCombinator:
+    """apCombinator enumerates combinations of the levels of every data object in an antiparser.
+
+       Instead of permuting every data object independently, each non-static data object gets a
+       list of levels: the sizes of its incremental mode schedule for apString, every keyword at
+       every one of those sizes for apKeywords, and the values of its schedule (the boundary table
+       in random mode) for the numeric data objects.  strategy decides which combinations of levels
+       make up the cases:
+
+       "product" is the full cross product of every level of every data object.
+
+       "pairwise" is an all-pairs covering array: every level of every data object is combined with
+       every level of every other data object at least once, in far fewer cases.
+
+       "sweep" varies one data object at a time, with every other data object at its first level.
+
+       Combinations are never materialized, except for the rows of the pairwise covering array,
+       which are built on first use.  len() is the number of cases, combinator[i] sets the
+       antiparser to case i and returns its payload, and iterating yields the payload of every
+       case in order.  Random content is drawn from the seed of the antiparser, which is set if
+       needed, so every case is reproducible.
+    """
+
+    def __init__(self, template, strategy="product"):
+        if strategy not in ("product", "pairwise", "sweep"):
+            raise ValueError("unknown strategy %r" % (strategy,))
+        if template.getSeed() is None:
+            template.setSeed(random.getrandbits(64))
+        self.template = template
+        self.strategy = strategy
+        self.fields = []  # (position, item, levels) of every varied data object
+        hints = _sizeHints(template.getList())
+        for (position, item) in enumerate(template.getList()):
+            if item.getStatic() or _isDerived(item):
+                continue
+            if isinstance(item, apNumber):
+                if item.getMode().lower() in _NUMBERMODES:
+                    values = item.getSchedule(hints).values
+                else:
+                    values = _numberValues("boundary", item.bits, item.signed, item.minsize, item.maxsize,
+                                           0, hints)
+                levels = [(None, value) for value in values]
+            elif isinstance(item, apBlock):
+                levels = [(None, count) for count in _incrementalSizes(item.getMinSize(), item.getMaxSize())]
+            else:
+                sizes = _incrementalSizes(item.getMinSize(), item.getMaxSize())
+                if isinstance(item, apKeywords):
+                    levels = [(keyword, size) for keyword in item.getKeywords() for size in sizes]
+                else:
+                    levels = [(None, size) for size in sizes]
+            self.fields.append((position, item, levels))
+        self.counts = [len(levels) for (position, item, levels) in self.fields]
+        self.current = [None] * len(self.fields)  # level each data object holds right now
+        self.rows = None
+        if strategy == "sweep":
+            # first case index at which each data object is varied
+            self.starts = []
+            total = 1
+            for count in self.counts:
+                self.starts.append(total)
+                total += count - 1
+            self.length = total
+        elif strategy == "pairwise" and len(self.fields) > 2:
+            self.length = None  # known once the covering array is built
+        else:
+            self.length = 1
+            for count in self.counts:
+                self.length *= count
+
+    def __len__(self):
+        if self.length is None:
+            self.rows = _pairwiseRows(self.counts)
+            self.length = len(self.rows)
+        return self.length
+
+    def getLevels(self, index):
+        """Returns the level index of every varied data object in case index."""
+        index = range(len(self))[index]
+        if self.rows is not None:
+            return self.rows[index]
+        if self.strategy == "sweep":
+            levels = [0] * len(self.fields)
+            if index:
+                field = bisect.bisect_right(self.starts, index) - 1
+                levels[field] = index - self.starts[field] + 1
+            return levels
+        levels = []
+        for count in reversed(self.counts):
+            (index, level) = divmod(index, count)
+            levels.append(level)
+        levels.reverse()
+        return levels
+
+    def __getitem__(self, index):
+        levels = self.getLevels(index)
+        seed = self.template.getSeed()
+        # only data objects whose level changed since the last case are touched
+        for (field, level) in enumerate(levels):
+            if level == self.current[field]:
+                continue
+            self.current[field] = level
+            (position, item, choices) = self.fields[field]
+            (keyword, value) = choices[level]
+            if isinstance(item, (apNumber, apBlock)):
+                item.setContent(value)
+                continue
+            if keyword is not None:
+                item.setCurrentKeyword(keyword)
+            item.setContent(_randomBytes(value, item.charset, _substream(seed, position, level)))
+        self.template.refresh(_substream(seed, -1, range(len(self))[index]))
+        return self.template.getPayload()
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
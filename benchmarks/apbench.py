@@ -0,0 +1,303 @@
+# apbench.py v1.0
+#
+# Benchmark suite for the antiparser.  Measures permutation, payload extraction,
+# incremental mode, save/load and apSocket send throughput, and compares the
+# results against a saved baseline so that regressions fail loudly.
+
+import os
+import sys
+import json
+import time
+import getopt
+import socket
+import platform
+import tempfile
+import threading
+from antiparser import *
+
+
+def usage():
+    help = """Usage: python apbench.py [options]
+        -b, --baseline [file]	Compare the results against a baseline JSON file and exit with status 1
+        			if any benchmark is slower than the baseline by more than the tolerance.
+        -f, --filter [text]	Only run benchmarks whose name contains text.
+        -h, --help		Display this help page.
+        -l, --list		List the benchmark names and exit.
+        -o, --output [file]	Save the results as JSON, for use as a baseline later on.
+        -t, --time [secs]	Minimum number of seconds to run each benchmark for (default is 1.0).
+        -T, --tolerance [pct]	Percentage a benchmark may fall below the baseline (default is 25).
+  """
+    print(help)
+
+
+SIZES = (16, 256, 4096, 65536)
+FIELDS = (10, 100, 1000)
+
+
+def permuteString(size):
+    # one apString of exactly size bytes, permuted in random mode
+    ap = antiparser()
+    item = apString()
+    item.setMinSize(size)
+    item.setMaxSize(size)
+    ap.append(item)
+    return (ap.permute, lambda: size)
+
+
+def permuteKeywords(size):
+    # one apKeywords field of exactly size bytes of content after the keyword
+    ap = antiparser()
+    item = apKeywords()
+    item.setKeywords(["USER", "PASS", "STOR", "RETR"])
+    item.setSeparator(" ")
+    item.setTerminator("\r\n")
+    item.setMinSize(size)
+    item.setMaxSize(size)
+    ap.append(item)
+    return (ap.permute, lambda: len(ap.getPayloadView()))
+
+
+def template(fields):
+    # a mix of numeric and string data objects, like a record based file format
+    ap = antiparser()
+    for index in range(fields):
+        if index % 4 == 3:
+            item = apString()
+            item.setMinSize(8)
+            item.setMaxSize(32)
+        else:
+            item = (apChar, apShort, apLong)[index % 4]()
+            item.setByteOrder("big")
+        ap.append(item)
+    return ap
+
+
+def extractAll(fields):
+    # every field changes, so the whole payload is extracted again
+    ap = template(fields)
+    return (ap.permute, lambda: len(ap.getPayloadView()))
+
+
+def extractOne(fields):
+    # a single field changes, so only its part of the payload is rendered again
+    ap = template(fields)
+    item = ap.getList()[fields // 2]
+    state = [0]
+
+    def run():
+        state[0] = (state[0] + 1) & 0xff
+        item.setContent(state[0])
+        ap.refresh()
+
+    return (run, lambda: len(ap.getPayloadView()))
+
+
+def incremental(size):
+    # steps an apString through its incremental mode schedule, starting over when it runs out
+    ap = antiparser()
+    item = apString()
+    item.setMode("incremental")
+    item.setMinSize(1)
+    item.setMaxSize(size)
+    ap.append(item)
+    schedule = item.getSchedule()
+
+    def run():
+        if schedule.getPosition() >= len(schedule):
+            ap.reset()
+        ap.permute()
+
+    return (run, lambda: len(ap.getPayloadView()))
+
+
+def roundTrip(fields):
+    # saves a permutation and loads it back into a new antiparser
+    ap = template(fields)
+    ap.permute()
+    (fd, fileName) = tempfile.mkstemp(suffix=".ap")
+    os.close(fd)
+
+    def run():
+        ap.save(fileName)
+        antiparser().load(fileName)
+
+    def cleanup():
+        os.unlink(fileName)
+
+    return (run, lambda: len(ap.getPayloadView()), cleanup)
+
+
+def echoServer():
+    # a loopback TCP echo server, returns its listening socket and port
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+
+    def serve():
+        try:
+            (conn, address) = server.accept()
+        except OSError:
+            return
+        buffer = bytearray(65536)
+        view = memoryview(buffer)
+        try:
+            while True:
+                read = conn.recv_into(buffer)
+                if not read:
+                    break
+                conn.sendall(view[:read])
+        except OSError:
+            pass
+        conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return (server, server.getsockname()[1])
+
+
+def sendTCP(size):
+    # sends one permutation of size bytes to a loopback echo server and reads the echo back
+    ap = antiparser()
+    item = apString()
+    item.setMinSize(size)
+    item.setMaxSize(size)
+    ap.append(item)
+    ap.permute()
+    (server, port) = echoServer()
+    sock = apSocket()
+    sock.connect("127.0.0.1", port)
+    sock.setTimeout(5)
+
+    def run():
+        sock.sendTCP(ap.getPayloadView())
+        if len(sock.recvExactly(size)) != size:
+            raise RuntimeError("echo server closed the connection")
+
+    def cleanup():
+        sock.close()
+        server.close()
+
+    return (run, lambda: size, cleanup)
+
+
+def benchmarks():
+    # (name, setup, argument) for every benchmark in the suite, in the order they are run
+    suite = []
+    for size in SIZES:
+        suite.append(("permute.apString.%d" % size, permuteString, size))
+    for size in SIZES:
+        suite.append(("permute.apKeywords.%d" % size, permuteKeywords, size))
+    for fields in FIELDS:
+        suite.append(("extract.all.%d" % fields, extractAll, fields))
+    for fields in FIELDS:
+        suite.append(("extract.one.%d" % fields, extractOne, fields))
+    for size in (1024, 65536):
+        suite.append(("incremental.apString.%d" % size, incremental, size))
+    for fields in FIELDS:
+        suite.append(("saveload.%d" % fields, roundTrip, fields))
+    for size in SIZES:
+        suite.append(("send.tcp.%d" % size, sendTCP, size))
+    return suite
+
+
+def measure(setup, argument, minimum):
+    """Runs a benchmark for at least minimum seconds and returns (ops/sec, bytes/sec)."""
+    fixture = setup(argument)
+    (run, size) = fixture[:2]
+    try:
+        run()  # warm up any caches, plans and connections
+        count = 1
+        while True:
+            total = 0
+            start = time.perf_counter()
+            for index in range(count):
+                run()
+                total += size()
+            elapsed = time.perf_counter() - start
+            if elapsed >= minimum:
+                return (count / elapsed, total / elapsed)
+            # aim for the minimum time in one more round
+            count = max(count * 2, int(count * minimum / max(elapsed, 1e-6) * 1.1))
+    finally:
+        if len(fixture) > 2:
+            fixture[2]()
+
+
+def compare(results, baseline, tolerance):
+    """Prints the benchmarks that are slower than the baseline, returns True if there were any."""
+    failed = False
+    for (name, old) in sorted(baseline["results"].items()):
+        if name not in results:
+            continue
+        ratio = results[name]["ops"] / old["ops"]
+        if ratio < 1 - tolerance:
+            failed = True
+            print("!! REGRESSION %-28s %12.1f ops/sec, was %12.1f (%+.1f%%) !!" % (name, results[name]["ops"],
+                                                                                  old["ops"], (ratio - 1) * 100))
+    return failed
+
+
+def main(argv):
+    # Defaults
+    BASELINE = None
+    FILTER = ""
+    OUTPUT = None
+    TIME = 1.0
+    TOLERANCE = 25.0
+
+    # Handle arguments
+    try:
+        opts, args = getopt.getopt(argv, "b:f:hlo:t:T:", ["baseline=", "filter=", "help", "list", "output=",
+                                                          "time=", "tolerance="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        if opt in ("-l", "--list"):
+            for (name, setup, argument) in benchmarks():
+                print(name)
+            sys.exit()
+        if opt in ("-b", "--baseline"):
+            BASELINE = arg
+        if opt in ("-f", "--filter"):
+            FILTER = arg
+        if opt in ("-o", "--output"):
+            OUTPUT = arg
+        if opt in ("-t", "--time"):
+            TIME = float(arg)
+        if opt in ("-T", "--tolerance"):
+            TOLERANCE = float(arg)
+
+    results = {}
+    print("%-28s %14s %16s" % ("benchmark", "ops/sec", "bytes/sec"))
+    for (name, setup, argument) in benchmarks():
+        if FILTER not in name:
+            continue
+        (ops, rate) = measure(setup, argument, TIME)
+        results[name] = {"ops": ops, "bytes": rate}
+        print("%-28s %14.1f %16.1f" % (name, ops, rate))
+
+    if OUTPUT:
+        report = {"python": platform.python_version(), "platform": platform.platform(),
+                  "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+        outfile = open(OUTPUT, "w")
+        json.dump(report, outfile, indent=2, sort_keys=True)
+        outfile.close()
+        print("++ Saved results to %s ++" % OUTPUT)
+
+    if BASELINE:
+        infile = open(BASELINE)
+        baseline = json.load(infile)
+        infile.close()
+        if compare(results, baseline, TOLERANCE / 100):
+            sys.exit(1)
+        print("++ No regressions against %s ++" % BASELINE)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -8,7 +8,9 @@
 # Make fuzzer more intelligent
 #       Test and tweak
 
+import os
 import sys
+import time
 import getopt
 import socket
 import string
@@ -19,22 +21,63 @@ from antiparser import *
 def usage():
     help = """Usage: python ap-FTPFuzz.py [options] host
         -c, --command [command]	Fuzz a particular FTP command
+        -C, --concurrency [n]	Send payloads over n concurrent connections (default and glob modes).
      	-d, --debug		Set debugging mode.
         -h, --help		Display this help page.
         -H, --host [host]	Specify a host other than the default of 127.0.0.1.
         -u, --user [user]	Specify FTP user.
         -p, --pass [pass]	Specify FTP pass.
         -P, --port [port]	Specify alternate FTP port (default is 21).
-        -s, --sleep [secs]	Number of seconds to sleep between requests.
+        -r, --rate [n]		Start out sending n requests per second.  The rate backs off while the server
+        			struggles and picks up again once it recovers.  Unpaced by default.
+        -s, --sleep [secs]	Number of seconds between requests to start out with, same as --rate 1/secs.
+        			0 starts out unpaced.
         --stdin			Prompt for user/pass using stdin
         --fmt			Format string fuzzing mode -- tests FTP commands for format strings.
         --glob			Glob fuzzing mode -- tests FTP commands with malformed globbing strings.
-        --save [directory]	Save each permutation to the specified directory.
-        NOTE: --save creates a lot of files depending on the fuzzer mode -- one for each payload sent.
+        --save [directory]	Save each permutation to a corpus file, named after the mode, in the specified
+        			directory.  Read it back with apCorpusReader.
+        --seed [seed]		Generate permutations from a seed.  With --save, each permutation is
+        			recorded as a (template hash, seed, case) line in directory/cases.txt
+        			instead of a pickle, and can be regenerated with antiparser.payloadAt().
   """
     print(help)
 
 
+def allBut(chars):
+    # every character except chars, for use as illegal characters
+    return "".join([chr(c) for c in range(256) if chr(c) not in chars])
+
+
+def replyDone(reply):
+    # a multi-line FTP reply starts with "230-" and ends with the line that starts with "230 "
+    last = reply[:-2].rsplit(b"\r\n", 1)[-1]
+    return reply[3:4] != b"-" or last[:3] == reply[:3] and last[3:4] == b" "
+
+
+def recvReply(sock, timeout=10):
+    try:
+        return sock.recvReply("\r\n", replyDone, timeout, 10240)
+    except socket.timeout:
+        return b""
+
+
+def save(ap, corpus, path, name, payload=None, index=None):
+    # seeded permutations only need their case key to be regenerated.  payload and index default
+    # to the current permutation
+    if ap.getSeed() is not None:
+        key = ap.getCaseKey(index)
+        print("++ Saving permutation %s as case %s ++" % (name, key[2]))
+        if not os.path.isdir(path):
+            os.mkdir(path, 0o700)
+        cases = open(os.path.join(path, "cases.txt"), "a")
+        cases.write("%s %s %s %s\n" % (name, key[0], key[1], key[2]))
+        cases.close()
+    else:
+        index = corpus.write(ap.getPayloadView() if payload is None else payload)
+        print("++ Saving permutation %s as case %s of %s ++" % (name, index, corpus.fileName))
+
+
 def main(argv):
     # Defaults
     TERMINATOR = "\r\n"
@@ -47,10 +90,11 @@ def main(argv):
     PASS = ""
     CMDFUZZ = False
     MODE = "default"
-    SLEEP = False
-    TIME = 0
+    RATE = None
     SAVE = False
     PATH = ""
+    SEED = None
+    CONCURRENCY = 0
 
     # List of commands, including several unsupported verbs (does not include a bunch of SITE subverbs)
     CMDLIST = ['ABOR', 'ALLO', 'APPE', 'CDUP', 'XCUP', 'CWD', 'XCWD', 'DELE', 'HELP', 'LIST', 'MKD',
@@ -60,9 +104,9 @@ def main(argv):
 
     # Handle arguments
     try:
-        opts, args = getopt.getopt(argv, "c:dhH:u:p:P:s:", ["command", "debug", "help", "host=", "user=",
-                                                            "pass=", "port=", "stdin", "fmt", "glob", "sleep=",
-                                                            "save="])
+        opts, args = getopt.getopt(argv, "c:C:dhH:u:p:P:r:s:", ["command", "concurrency=", "debug", "help", "host=",
+                                                            "user=", "pass=", "port=", "rate=", "stdin", "fmt", "glob",
+                                                            "sleep=", "save=", "seed="])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -72,6 +116,8 @@ def main(argv):
             sys.exit()
         if opt in ("-c", "--command"):
             CMD = arg
+        if opt in ("-C", "--concurrency"):
+            CONCURRENCY = int(arg)
         if opt in ("-d", "--debug"):
             DEBUG = True
         if opt in ("-u", "--user"):
@@ -84,26 +130,40 @@ def main(argv):
             HOST = arg
         if opt in ("-P", "--port"):
             PORT = int(arg)
+        if opt in ("-r", "--rate"):
+            RATE = float(arg)
         if opt in ("-s", "--sleep"):
-            SLEEP = True
-            TIME = int(arg)
-        if opt in ("--save"):
+            # no sleep leaves the requests unpaced until the server struggles
+            RATE = 1.0 / float(arg) if float(arg) else None
+        if opt == "--save":
             SAVE = True
             PATH = arg
-        if opt in ("--stdin"):
+        if opt == "--seed":
+            SEED = int(arg)
+        if opt == "--stdin":
             AUTH = True
             USER = input('Username: ')
             PASS = getpass.getpass('Password: ')
-        if opt in ("--fmt"):
+        if opt == "--fmt":
             MODE = "fmt"
-        if opt in ("--glob"):
+        if opt == "--glob":
             MODE = "glob"
 
-    table = string.maketrans('', '')
-    illegal = string.translate(table, table, string.ascii_letters + string.digits)
+    illegal = allBut(string.ascii_letters + string.digits)
+
+    # only print replies unlike any seen before, along with a summary at the end
+    monitor = apMonitor()
+    # back off while the server struggles
+    pacer = apPacer(RATE)
+
+    corpus = None
+    if SAVE and SEED is None:
+        corpus = apCorpusWriter(os.path.join(PATH, MODE + ".corpus"))
 
     # set up antiparser
 
+    # numbers the format string cases across commands, so monitor reports can be told apart
+    case = 0
     for cmd in CMDLIST:
         ap = antiparser()
         cmdkw = apKeywords()
@@ -117,13 +177,15 @@ def main(argv):
             cmdkw.setContent(r"%n%n%n%n%n%n%n%n%n%n%n%n%n%n%n%n")
             cmdkw.setOptional(True)
         elif MODE == "glob":
-            illegal = string.translate(table, table, "/.{}~*?")
+            illegal = allBut("/.{}~*?")
             cmdkw.setIllegalChars(illegal)
         else:
             cmdkw.setIllegalChars(illegal)
         cmdkw.setMode('incremental')
         cmdkw.setMaxSize(65536)
         ap.append(cmdkw)
+        if SEED is not None:
+            ap.setSeed(SEED)
 
         if MODE == "default" or MODE == "glob":
             if MODE == "glob":
@@ -131,55 +193,76 @@ def main(argv):
                            'XMKD', 'MDTM', 'NLST', 'PWD', 'XPWD', 'RETR', 'RMD', 'XRMD',
                            'RNFR', 'RNTO', 'STOR', 'STOU']
 
-            for i in range(1, 65):
-                ap.permute()
-                sock = apSocket()
-                print("++ Connecting to Server: %s %s" % (HOST, PORT))
-                sock.connect(HOST, PORT)
-                # print banner
-                print(sock.recv(10240))
+            if CONCURRENCY:
+                runner = apAsyncRunner(HOST, PORT, CONCURRENCY)
+                runner.setPacer(pacer)
                 if AUTH:
-                    print("++ Sending USER credentials ++")
-                    sock.sendTCP("USER " + USER + TERMINATOR)
-                    print(sock.recv(10240))
-                    print("++ Sending PASS credentials ++")
-                    sock.sendTCP("PASS " + PASS + TERMINATOR)
-                    print(sock.recv(10240))
+                    runner.setPreamble(["USER " + USER + TERMINATOR, "PASS " + PASS + TERMINATOR])
+                print("++ Sending command: %s over %s connections ++" % (cmd, CONCURRENCY))
+                first = ap.getCase()
+                payloads = ap.permuteMany(64)
+                for result in runner.run(payloads):
+                    if monitor.check(result, payloads[result.index]):
+                        print("++ Case %s: %s %s (%s) ++" % (result.index, result.outcome, result.response,
+                                                            result.error or result.latency))
+                if SAVE:
+                    for (offset, payload) in enumerate(payloads):
+                        save(ap, corpus, PATH, cmd + "fuzz" + str(offset + 1), payload, first + offset)
+                continue
 
+            # log in once per pooled connection rather than once per payload
+            session = apSession(HOST, PORT, timeout=10)
+            session.setReply(TERMINATOR, replyDone)
+            session.addRecv(10240)
+            if AUTH:
+                session.addSend("USER " + USER + TERMINATOR, 10240)
+                session.addSend("PASS " + PASS + TERMINATOR, 10240)
+            print("++ Connecting to Server: %s %s" % (HOST, PORT))
+            for i in range(1, 65):
+                ap.permute()
                 print("++ Sending command: %s Length: %s ++" % (cmd, cmdkw.getContentSize()))
-                sock.sendTCP(ap.getPayload())
-                print(sock.recv(1024))
-                sock.close()
+                pacer.wait()
+                start = time.perf_counter()
+                try:
+                    result = apResult(i, session.send(ap.getPayloadView(), 10240), time.perf_counter() - start)
+                except OSError as err:
+                    result = apResult(i, error=err.__class__.__name__)
+                pacer.done(result)
+                if monitor.check(result, ap.getPayloadView()):
+                    print("++ %s: %s ++" % (result.outcome, result.response))
                 if SAVE:
-                    file = PATH + "/" + cmd + "fuzz" + str(i)
-                    print("++ Saving permutation as %s ++" % file)
-                    ap.save(file)
-                if SLEEP:
-                    sock.sleep(TIME)
+                    save(ap, corpus, PATH, cmd + "fuzz" + str(i))
+            session.close()
 
         if MODE == "fmt":
             sock = apSocket()
             print("++ Connecting to server: %s %s ++" % (HOST, PORT))
             sock.connect(HOST, PORT)
             # print banner
-            print(sock.recv(1024))
+            print(recvReply(sock))
             if AUTH:
                 print("++ Sending USER credentials ++")
                 sock.sendTCP("USER " + USER + TERMINATOR)
-                print(sock.recv(1024))
+                print(recvReply(sock))
                 print("++ Sending PASS credentials ++")
                 sock.sendTCP("PASS " + PASS + TERMINATOR)
-                print(sock.recv(1024))
+                print(recvReply(sock))
             print("++ Sending command: %s (Format String Mode) ++" % cmd)
-            sock.sendTCP(ap.getPayload())
-            print(sock.recv(1024))
+            sock.setMonitor(monitor)
+            # a server that never replies is recorded as a timeout rather than hanging the run
+            sock.setTimeout(10)
+            case += 1
+            pacer.wait()
+            result = sock.sendCase(ap.getPayload(), 10240, index=case, terminator=TERMINATOR, complete=replyDone)
+            pacer.done(result)
+            print("++ %s: %s ++" % (result.outcome, result.error or result.response))
             sock.close()
             if SAVE:
-                file = PATH + "/" + cmd + "fuzz" + str(i)
-                print("++ Saving permutation as %s ++" % file)
-                ap.save(file)
-            if SLEEP:
-                sock.sleep(TIME)
+                save(ap, corpus, PATH, cmd + "fuzz" + str(case))
+
+    if corpus is not None:
+        corpus.close()
+    monitor.display()
 
 
 if __name__ == "__main__":
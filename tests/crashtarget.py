@@ -0,0 +1,46 @@
+# crashtarget.py
+#
+# A target for the apProcessPool tests.  Speaks the apProcessPool protocol on stdin and stdout,
+# reading payloads from stdin or from the file named on the command line.  A payload starting
+# with "crash" raises SIGSEGV, one starting with "hang" never acknowledges, and one starting
+# with "exit" exits with status 3.
+
+import os
+import signal
+import struct
+import sys
+import time
+
+
+def readExactly(stream, size):
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            sys.exit(0)
+        data += chunk
+    return data
+
+
+def main(argv):
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    while True:
+        (size,) = struct.unpack("<I", readExactly(stdin, 4))
+        if argv:
+            with open(argv[0], "rb") as infile:
+                payload = infile.read(size)
+        else:
+            payload = readExactly(stdin, size)
+        if payload.startswith(b"crash"):
+            os.kill(os.getpid(), signal.SIGSEGV)
+        if payload.startswith(b"hang"):
+            time.sleep(60)
+        if payload.startswith(b"exit"):
+            sys.exit(3)
+        stdout.write(b"\x01")
+        stdout.flush()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
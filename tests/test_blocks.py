@@ -0,0 +1,91 @@
+import unittest
+
+from antiparser import *
+
+
+def staticString(content, optional=False):
+    item = apString()
+    item.setContent(content)
+    item.setStatic(True)
+    item.setOptional(optional)
+    return item
+
+
+class BlockTest(unittest.TestCase):
+    """Rendering of apBlock, and reproducibility of seeded cases that hold blocks."""
+
+    def setUp(self):
+        self.ap = antiparser()
+        self.block = apBlock()
+        self.block.append(staticString(b"aaa", optional=True))
+        child = apString()
+        child.setMaxSize(4)
+        self.block.append(child)
+        self.ap.append(self.block)
+        tail = apString()
+        tail.setMaxSize(8)
+        self.ap.append(tail)
+
+    def testPayloadAtDoesNotDependOnHistory(self):
+        for template in (self.ap, self.optionalOnly()):
+            template.setSeed(0)
+            forward = [template.payloadAt(index) for index in range(40)]
+            backward = [template.payloadAt(index) for index in reversed(range(40))]
+            backward.reverse()
+            self.assertEqual(forward, backward)
+            self.assertEqual([template.payloadAt(index) for index in (1, 2, 1, 2, 1)],
+                             [forward[1], forward[2], forward[1], forward[2], forward[1]])
+
+    def optionalOnly(self):
+        # a block whose only child is static and optional, so the cases differ by inclusion alone
+        ap = antiparser()
+        block = apBlock()
+        block.append(staticString(b"aaa", optional=True))
+        ap.append(block)
+        return ap
+
+    def testPayloadAtMatchesAFreshTemplate(self):
+        self.ap.setSeed(7)
+        for index in range(10):
+            self.ap.payloadAt(index)
+        case = self.ap.payloadAt(13)
+        self.setUp()
+        self.ap.setSeed(7)
+        self.assertEqual(self.ap.payloadAt(13), case)
+
+    def testRenderMatchesPayload(self):
+        for index in range(20):
+            self.ap.permute()
+            (offset, size) = self.ap.getSpan(self.block)
+            self.assertEqual(self.ap.getPayload()[offset:offset + size], self.block.render())
+
+    def testRepeatCount(self):
+        self.ap.permute()
+        once = self.block.render()
+        self.block.setContent(3)
+        self.ap.refresh()
+        self.assertEqual(self.block.render(), once * 3)
+        self.assertTrue(self.ap.getPayload().startswith(once * 3))
+
+    def testStaticBlockIsNotPermuted(self):
+        self.ap.permute()
+        self.block.setStatic(True)
+        rendered = self.block.render()
+        for index in range(10):
+            self.ap.permute()
+            self.assertEqual(self.block.render(), rendered)
+        self.ap.setSeed(3)
+        for index in range(10):
+            self.ap.payloadAt(index)
+            self.assertEqual(self.block.render(), rendered)
+
+    def testChangedChildIsRenderedAgain(self):
+        self.ap.permute()
+        child = self.block.getList()[1]
+        child.setContent(b"zzzz")
+        self.ap.refresh()
+        self.assertIn(b"zzzz", self.ap.getPayload())
+
+
+if __name__ == "__main__":
+    unittest.main()
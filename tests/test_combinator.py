@@ -0,0 +1,69 @@
+import itertools
+import unittest
+
+from antiparser import *
+
+
+def template():
+    ap = antiparser()
+    for (cls, maxsize) in ((apChar, 40), (apShort, 300), (apString, 8), (apChar, 5)):
+        item = cls()
+        item.setMaxSize(maxsize)
+        ap.append(item)
+    keywords = apKeywords()
+    keywords.setKeywords(["USER", "PASS", "RETR"])
+    keywords.setMaxSize(4)
+    ap.append(keywords)
+    ap.setSeed(1234)
+    return ap
+
+
+class CombinatorTest(unittest.TestCase):
+    """Case counts and coverage of the apCombinator strategies."""
+
+    def testPairwiseCoversEveryPair(self):
+        combinator = apCombinator(template(), "pairwise")
+        counts = combinator.counts
+        rows = [tuple(combinator.getLevels(index)) for index in range(len(combinator))]
+        for (first, second) in itertools.combinations(range(len(counts)), 2):
+            covered = set((row[first], row[second]) for row in rows)
+            self.assertEqual(len(covered), counts[first] * counts[second], (first, second))
+
+    def testPairwiseIsSmallerThanProduct(self):
+        pairwise = len(apCombinator(template(), "pairwise"))
+        product = len(apCombinator(template(), "product"))
+        counts = sorted(apCombinator(template()).counts)
+        self.assertGreaterEqual(pairwise, counts[-1] * counts[-2])
+        self.assertLess(pairwise, product)
+
+    def testProductAndSweepLengths(self):
+        combinator = apCombinator(template(), "product")
+        total = 1
+        for count in combinator.counts:
+            total *= count
+        self.assertEqual(len(combinator), total)
+        sweep = apCombinator(template(), "sweep")
+        self.assertEqual(len(sweep), 1 + sum(count - 1 for count in sweep.counts))
+
+    def testCasesAreReproducible(self):
+        first = apCombinator(template(), "pairwise")
+        second = apCombinator(template(), "pairwise")
+        indexes = [5, 0, len(first) - 1, 5]
+        self.assertEqual([first[index] for index in indexes], [second[index] for index in indexes])
+        self.assertEqual(first[3], list(first)[3])
+
+    def testPayloadFollowsLevels(self):
+        ap = template()
+        combinator = ap.combinations("sweep")
+        for index in range(len(combinator)):
+            combinator[index]
+            for ((position, item, levels), level) in zip(combinator.fields, combinator.getLevels(index)):
+                (keyword, value) = levels[level]
+                if isinstance(item, apNumber):
+                    self.assertEqual(item.getContent(), value)
+                else:
+                    self.assertEqual(len(item.getContent()), value)
+
+
+if __name__ == "__main__":
+    unittest.main()
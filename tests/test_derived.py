@@ -0,0 +1,107 @@
+import random
+import struct
+import unittest
+import zlib
+
+from antiparser import *
+
+
+def fixedString(content):
+    item = apString()
+    item.setContent(content)
+    return item
+
+
+class DerivedTest(unittest.TestCase):
+    """Values computed for length, count and checksum fields while the payload is packed."""
+
+    def setUp(self):
+        self.ap = antiparser()
+        self.field = apLong()
+        self.field.setByteOrder("big")
+        self.body = [fixedString(b"hello"), fixedString(b"world!")]
+        self.ap.append(self.field)
+        for item in self.body:
+            self.ap.append(item)
+
+    def derived(self):
+        return struct.unpack(">I", self.ap.getPayload()[:4])[0]
+
+    def testLengthOf(self):
+        self.field.setLengthOf(self.body)
+        self.ap.refresh()
+        self.assertEqual(self.derived(), 11)
+        self.body[1].setContent(b"")
+        self.ap.refresh()
+        self.assertEqual(self.derived(), 5)
+
+    def testLengthOfNumbers(self):
+        short = apShort()
+        self.ap.append(short)
+        self.field.setLengthOf([short, self.field])
+        self.ap.refresh()
+        self.assertEqual(self.derived(), 6)
+
+    def testCountOf(self):
+        self.field.setCountOf(self.body)
+        self.ap.refresh()
+        self.assertEqual(self.derived(), 2)
+
+    def testCountOfLeavesOutOptionalItems(self):
+        self.body[1].setOptional(True)
+        self.field.setCountOf(self.body)
+        for index in range(32):
+            self.ap.refresh()
+            included = self.ap.getSpan(self.body[1]) is not None
+            self.assertEqual(self.derived(), 2 if included else 1)
+
+    def testChecksumOf(self):
+        for (algorithm, function) in (("crc32", zlib.crc32), ("adler32", zlib.adler32),
+                                      ("sum", lambda data: sum(bytearray(data)))):
+            self.field.setChecksumOf(self.body, algorithm)
+            self.ap.refresh()
+            self.assertEqual(self.derived(), function(b"helloworld!") & 0xffffffff, algorithm)
+
+    def testChecksumFollowsContent(self):
+        self.field.setChecksumOf(self.body)
+        self.ap.refresh()
+        self.body[0].setContent(b"HELLO")
+        self.ap.refresh()
+        self.assertEqual(self.derived(), zlib.crc32(b"HELLOworld!") & 0xffffffff)
+
+    def testChecksumCoversLength(self):
+        length = apShort()
+        length.setByteOrder("big")
+        length.setLengthOf(self.body)
+        self.ap.append(length)
+        self.field.setChecksumOf([length] + self.body)
+        self.ap.refresh()
+        self.assertEqual(self.derived(), zlib.crc32(b"\x00\x0bhelloworld!") & 0xffffffff)
+
+    def testValuesAreTruncated(self):
+        char = apChar()
+        self.ap.append(char)
+        self.body[0].setContent(b"x" * 300)
+        char.setLengthOf(self.body)
+        self.ap.refresh()
+        self.assertEqual(bytearray(self.ap.getPayload())[-1], 306 & 0xff)
+
+    def testFuzzedVariantIsWrong(self):
+        self.field.setLengthOf(self.body, "fuzzed")
+        rng = random.Random(0)
+        values = set()
+        for index in range(64):
+            self.ap.refresh(rng)
+            values.add(self.derived())
+        self.assertNotIn(11, values)
+        self.assertGreater(len(values), 1)
+
+    def testPermuteKeepsLengthCorrect(self):
+        self.field.setLengthOf(self.body)
+        for index in range(16):
+            self.ap.permute()
+            self.assertEqual(self.derived(), len(self.ap.getPayload()) - 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
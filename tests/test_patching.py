@@ -0,0 +1,90 @@
+import unittest
+
+from antiparser import *
+
+
+class PatchingTest(unittest.TestCase):
+    """Incremental patching of the payload buffer: in place, spliced or rebuilt."""
+
+    def setUp(self):
+        self.ap = antiparser()
+        self.items = []
+        for content in (b"aaaa", b"bbbb", b"cccc"):
+            item = apString()
+            item.setContent(content)
+            self.ap.append(item)
+            self.items.append(item)
+        self.assertEqual(self.ap.getPayload(), b"aaaabbbbcccc")
+
+    def buffer(self):
+        return self.ap._antiparser__buffer
+
+    def testSameLengthIsWrittenInPlace(self):
+        buffer = self.buffer()
+        self.items[1].setContent(b"BBBB")
+        self.items[2].setContent(b"CCCC")
+        self.ap.refresh()
+        self.assertEqual(self.ap.getPayload(), b"aaaaBBBBCCCC")
+        self.assertIs(self.buffer(), buffer)
+
+    def testOneResizedStepIsSpliced(self):
+        buffer = self.buffer()
+        self.items[1].setContent(b"xy")
+        self.ap.refresh()
+        self.assertEqual(self.ap.getPayload(), b"aaaaxycccc")
+        self.assertIs(self.buffer(), buffer)
+        self.assertEqual(self.ap.getSpan(self.items[2]), (6, 4))
+
+    def testSeveralResizedStepsAreRebuilt(self):
+        buffer = self.buffer()
+        self.items[0].setContent(b"a")
+        self.items[2].setContent(b"cccccc")
+        self.ap.refresh()
+        self.assertEqual(self.ap.getPayload(), b"abbbbcccccc")
+        self.assertIsNot(self.buffer(), buffer)
+        self.assertEqual(self.ap.getSpan(self.items[1]), (1, 4))
+
+    def testHeldViewFallsBackToRebuild(self):
+        view = self.ap.getPayloadView()
+        buffer = self.buffer()
+        self.items[1].setContent(b"bbbbbbbb")
+        self.ap.refresh()  # splicing would resize a buffer that is still exported
+        self.assertEqual(self.ap.getPayload(), b"aaaabbbbbbbbcccc")
+        self.assertIsNot(self.buffer(), buffer)
+        self.assertEqual(bytes(view), b"aaaabbbbcccc")
+        view.release()
+
+    def testSplicedPayloadMatchesAFreshOne(self):
+        self.items[1].setContent(b"")
+        self.ap.refresh()
+        fresh = antiparser()
+        for item in self.items:
+            fresh.append(item)
+        self.assertEqual(self.ap.getPayload(), fresh.getPayload())
+
+    def testOnlyDirtyStepsAreRendered(self):
+        self.ap.refresh()
+        self.items[0].content = b"AAAA"  # not marked dirty, so not rendered again
+        self.items[2].setContent(b"CCCC")
+        self.ap.refresh()
+        self.assertEqual(self.ap.getPayload(), b"aaaabbbbCCCC")
+
+    def testChangesReachEveryContainer(self):
+        other = antiparser()
+        other.append(self.items[1])
+        self.assertEqual(other.getPayload(), b"bbbb")
+        self.items[1].setContent(b"xyz")
+        self.ap.refresh()
+        other.refresh()
+        self.assertEqual(self.ap.getPayload(), b"aaaaxyzcccc")
+        self.assertEqual(other.getPayload(), b"xyz")
+
+    def testDeletedItemsStopReporting(self):
+        item = self.items[1]
+        self.ap.delete(item)
+        self.assertEqual(self.ap.getPayload(), b"aaaacccc")
+        self.assertEqual(item.watchers, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import sys
+import unittest
+
+from antiparser import *
+
+TARGET = os.path.join(os.path.dirname(os.path.abspath(__file__)), "crashtarget.py")
+
+
+class ProcessPoolTest(unittest.TestCase):
+    """Failure detection and worker restarts of apProcessPool, against tests/crashtarget.py."""
+
+    def pool(self, workers=1, timeout=2.0, delivery="stdin"):
+        command = [sys.executable, TARGET] + (["@@"] if delivery == "file" else [])
+        pool = apProcessPool(command, workers, timeout, delivery)
+        self.addCleanup(pool.close)
+        return pool
+
+    def testCleanCasesPass(self):
+        pool = self.pool()
+        self.assertEqual(pool.run([b"ok"] * 20), [])
+        self.assertEqual(pool.cases, 20)
+        self.assertEqual(pool.restarts, 0)
+
+    def testSegfaultIsDetected(self):
+        pool = self.pool()
+        results = pool.run([b"ok", b"crash", b"ok", b"ok"])
+        self.assertEqual([(result.index, result.error) for result in results], [(1, "SIGSEGV")])
+        self.assertEqual(pool.cases, 4)
+        self.assertEqual(pool.restarts, 1)
+
+    def testExitStatusIsDetected(self):
+        results = self.pool().run([b"exit"])
+        self.assertEqual([result.error for result in results], ["exit 3"])
+
+    def testTimeoutKillsTheTarget(self):
+        pool = self.pool(timeout=0.5)
+        results = pool.run([b"hang", b"ok"])
+        self.assertEqual([(result.index, result.error) for result in results], [(0, "timeout")])
+        self.assertGreaterEqual(results[0].latency, 0.5)
+        self.assertEqual(pool.restarts, 1)
+
+    def testRestartsAreCounted(self):
+        pool = self.pool(workers=3)
+        payloads = [b"crash" if index % 4 == 0 else b"ok" for index in range(24)]
+        results = pool.run(payloads)
+        self.assertEqual([result.index for result in results], list(range(0, 24, 4)))
+        self.assertEqual(set(result.error for result in results), set(["SIGSEGV"]))
+        self.assertEqual(pool.cases, 24)
+        self.assertEqual(pool.restarts, 6)
+
+    def testFileDelivery(self):
+        pool = self.pool(delivery="file")
+        results = pool.run([b"ok", b"crash", b"ok" * 1000])
+        self.assertEqual([(result.index, result.error) for result in results], [(1, "SIGSEGV")])
+        self.assertEqual(pool.restarts, 1)
+
+    def testCallback(self):
+        failures = []
+        results = self.pool().run([b"crash", b"ok"], failures.append)
+        self.assertEqual(results, [])
+        self.assertEqual([result.error for result in failures], ["SIGSEGV"])
+
+
+if __name__ == "__main__":
+    unittest.main()
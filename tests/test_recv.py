@@ -0,0 +1,52 @@
+import socket
+import unittest
+
+from antiparser import *
+
+
+class RecvTest(unittest.TestCase):
+    """Framed receives of apSocket over a loopback connection."""
+
+    def setUp(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        self.sock = apSocket()
+        self.sock.connect("127.0.0.1", server.getsockname()[1])
+        (self.peer, address) = server.accept()
+        server.close()
+        self.addCleanup(self.sock.close)
+        self.addCleanup(self.peer.close)
+
+    def testRecvUntil(self):
+        self.peer.sendall(b"220 ready\r\n331 password\r\n")
+        self.assertEqual(self.sock.recvUntil("\r\n", 5), b"220 ready\r\n")
+        self.assertEqual(self.sock.recvUntil(b"\r\n", 5), b"331 password\r\n")
+
+    def testMaxSizeStopsBeforeTheTerminator(self):
+        self.peer.sendall(b"x" * 50 + b"\r\nnext\r\n")
+        self.assertEqual(self.sock.recvUntil("\r\n", 5, 10), b"x" * 10)
+        self.assertEqual(self.sock.recvUntil("\r\n", 5, 42), b"x" * 40 + b"\r\n")
+        self.assertEqual(self.sock.recvUntil("\r\n", 5), b"next\r\n")
+
+    def testRecvReplyReadsEveryLine(self):
+        self.peer.sendall(b"230-welcome\r\n230-to the\r\n230 server\r\n200 ok\r\n")
+
+        def complete(reply):
+            return reply.rsplit(b"\r\n", 2)[-2][3:4] == b" "
+
+        self.assertEqual(self.sock.recvReply("\r\n", complete, 5), b"230-welcome\r\n230-to the\r\n230 server\r\n")
+        self.assertEqual(self.sock.recvReply("\r\n", complete, 5), b"200 ok\r\n")
+
+    def testRecvReplyMaxSize(self):
+        self.peer.sendall(b"230-" + b"y" * 30 + b"\r\n230 end\r\n")
+        self.assertEqual(len(self.sock.recvReply("\r\n", lambda reply: False, 5, 16)), 16)
+
+    def testTimeoutReturnsPartialReply(self):
+        self.peer.sendall(b"230-first\r\n")
+        self.assertEqual(self.sock.recvReply("\r\n", lambda reply: False, 0.2), b"230-first\r\n")
+        self.assertRaises(socket.timeout, self.sock.recvReply, "\r\n", None, 0.2)
+
+
+if __name__ == "__main__":
+    unittest.main()